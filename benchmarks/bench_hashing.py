@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''
+Compares the hashing engine in utils/hashing.py with the old inline
+`calc_hash` (blocking f.read() + md5 on the event loop) on a synthetic asset tree.
+
+usage: python benchmarks/bench_hashing.py [--files N] [--max-size BYTES] [--seed N]
+'''
+import argparse
+import asyncio
+import hashlib
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import utils.hashing as hashing
+
+
+def make_asset_tree(root:Path, files:int, max_size:int, seed:int=0) -> list[Path]:
+    '''
+    Creates a tree of files with a size distribution similar to the asset pack
+    (lots of small textures/json, a few large sounds)
+    '''
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        path = root / f"ns{i % 7}" / f"dir{i % 53}" / f"asset{i}.bin"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size = min(max_size, int(rng.lognormvariate(9, 1.6)))
+        path.write_bytes(rng.randbytes(size))
+        paths.append(path)
+    return paths
+
+
+async def legacy_calc_hash(file:Path):
+    with open(file,'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+async def run_legacy(paths):
+    return await asyncio.gather(*(legacy_calc_hash(p) for p in paths))
+
+
+async def run_engine(paths):
+    return await asyncio.gather(*(hashing.calc_hash(p) for p in paths))
+
+
+def measure(name, func, paths, total_bytes):
+    start = time.perf_counter()
+    result = asyncio.run(func(paths))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<8} {elapsed * 1000:9.1f} ms  {total_bytes / elapsed / 1e6:9.1f} MB/s  {len(paths) / elapsed:10.0f} files/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--max-size", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_asset_tree(Path(tmp), args.files, args.max_size, args.seed)
+        total_bytes = sum(p.stat().st_size for p in paths)
+        print(f"{len(paths)} files, {total_bytes / 1e6:.1f} MB, {hashing.HASH_WORKERS} hash workers (page cache warm)")
+        legacy = measure("legacy", run_legacy, paths, total_bytes)
+        engine = measure("engine", run_engine, paths, total_bytes)
+        assert legacy == engine, "digests differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+'''
+Offline micro-benchmarks for the hot functions of a launch, run on synthetic
+fixtures: asset verification/hashing, the installed mod index, modpack
+filtering, Modrinth version matching and maven url building.
+
+Every case reports the median time over --runs iterations and the peak
+traced memory of one extra iteration. Results can be saved as a baseline
+and later runs compared against it.
+
+usage: python benchmarks/bench_hot_paths.py [--assets N] [--mods N] [--runs N]
+           [--only NAME ...] [--save FILE] [--baseline FILE] [--max-regression PCT]
+'''
+import argparse
+import asyncio
+import atexit
+import copy
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+from bench_hashing import make_asset_tree
+
+# the task modules create their folders relative to the cwd on import
+CWD = Path.cwd()
+FIXTURES = tempfile.mkdtemp(prefix="nrc-bench-")
+atexit.register(shutil.rmtree, FIXTURES, ignore_errors=True)
+os.chdir(FIXTURES)
+import networking.api as api
+import networking.http_cache as http_cache
+import networking.modrinth_api as modrinth
+import tasks.get_assets as get_assets
+import tasks.install_norisk_version as install_norisk_version
+import utils.hashing as hashing
+
+MC_VERSION = "1.21.4"
+OTHER_MC_VERSIONS = ["1.8.9", "1.20.1", "1.20.4", "1.21", "1.21.1", "1.21.3"]
+MAVEN_REPOS = {"norisk": "https://maven.norisk.gg/repository/norisk-production/"}
+
+
+def make_modpacks(mods:int, seed:int=0) -> dict:
+    '''
+    Creates a modpacks payload shaped like the one of the norisk api
+    '''
+    rng = random.Random(seed)
+    pack = []
+    for i in range(mods):
+        compatibility = {
+            v: {"fabric": {"identifier": f"{i}.{rng.randrange(20)}.0+{v}"}}
+            for v in rng.sample(OTHER_MC_VERSIONS, 3)
+        }
+        if rng.random() < 0.8:
+            compatibility[MC_VERSION] = {"fabric": {"identifier": f"{i}.{rng.randrange(20)}.0+{MC_VERSION}"}}
+        if rng.random() < 0.5:
+            source = {"type": "modrinth", "projectId": f"proj{i:05d}"}
+        else:
+            source = {"type": "maven", "repositoryRef": "norisk", "groupId": f"gg.norisk.mod{i % 17}", "artifactId": f"mod{i}"}
+        pack.append({"id": f"mod{i}", "displayName": f"Mod {i}", "compatibility": compatibility, "source": source})
+    return {"packs": {"norisk-prod": {"mods": pack}}, "repositories": MAVEN_REPOS}
+
+
+def make_version_history(length:int) -> list:
+    '''
+    Creates Modrinth version objects for one project, newest first
+    '''
+    versions = []
+    for i in range(length):
+        loaders = ["fabric"] if i % 3 else ["forge", "neoforge"]
+        versions.append({
+            "id": f"v{i:06d}",
+            "version_number": f"{length - i}.0.0+{OTHER_MC_VERSIONS[i % len(OTHER_MC_VERSIONS)]}",
+            "loaders": loaders,
+            "files": [{"url": f"https://cdn.modrinth.com/{i}.jar", "filename": f"{i}.jar", "primary": True}],
+        })
+    return versions
+
+
+def make_mods_dir(mods:int, seed:int=0) -> dict:
+    '''
+    Fills ./mods with fake jars and returns a matching index (mod id -> entry)
+    '''
+    rng = random.Random(seed)
+    os.makedirs("./mods", exist_ok=True)
+    index = {}
+    for i in range(mods):
+        name = f"mod{i}-{i}.0.0.jar"
+        data = rng.randbytes(int(rng.lognormvariate(12, 1)))
+        with open(f"./mods/{name}", "wb") as f:
+            f.write(data)
+        st = os.stat(f"./mods/{name}")
+        index[f"mod{i}"] = {
+            "filename": name,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "hash": hashing.file_digest(f"./mods/{name}", "md5"),
+            "version": f"{i}.0.0",
+        }
+    return index
+
+
+def write_index(mods:dict|list):
+    with open(install_norisk_version.INDEX_PATH, "w") as f:
+        if isinstance(mods, list):
+            json.dump(mods, f)
+        else:
+            json.dump({"version": install_norisk_version.INDEX_VERSION, "mods": mods}, f)
+
+
+def build_cases(args) -> dict:
+    '''
+    Creates the fixtures
+
+    Returns:
+        cases:dict | name -> (setup, run), setup is called before every
+        iteration and its result is passed to the async run function
+    '''
+    rng = random.Random(args.seed)
+    cases = {}
+
+    assets = make_asset_tree(Path(get_assets.ASSET_PATH), args.assets, args.max_asset_size, args.seed)
+    objects = {}
+    for path in assets:
+        name = path.relative_to(get_assets.ASSET_PATH).as_posix()
+        objects[name] = (hashing.file_digest(path, "md5"), path.stat().st_size)
+
+    async def verify_all(_):
+        return await asyncio.gather(*(get_assets.verify_asset(name, data) for name, data in objects.items()))
+
+    cases["verify_asset (cold)"] = (get_assets.hash_cache.clear, verify_all)
+    cases["verify_asset (stat cache)"] = (lambda: None, verify_all)
+
+    async def hash_all(_):
+        return await asyncio.gather(*(hashing.calc_hash(path) for path in assets))
+
+    cases["calc_hash"] = (lambda: None, hash_all)
+
+    index = make_mods_dir(args.mods, args.seed)
+
+    async def installed_versions(_):
+        return await install_norisk_version.get_installed_versions()
+
+    cases["get_installed_versions"] = (lambda: write_index(index), installed_versions)
+    # entries without stat data, every jar is hashed and matched once
+    legacy = [{"id": mod_id, "hash": entry["hash"], "version": entry["version"]} for mod_id, entry in index.items()]
+    cases["get_installed_versions (migration)"] = (lambda: write_index(legacy), installed_versions)
+
+    modpacks = http_cache.apply_view(api.NoriskProdMods(MC_VERSION), make_modpacks(args.modpack_mods, args.seed))
+
+    async def get_norisk_versions(mc_version):
+        return modpacks
+
+    api.get_norisk_versions = get_norisk_versions
+
+    async def compatible_mods(_):
+        return await install_norisk_version.get_compatible_nrc_mods(MC_VERSION)
+
+    cases["get_compatible_nrc_mods"] = (lambda: None, compatible_mods)
+
+    compatible, repos = asyncio.run(install_norisk_version.get_compatible_nrc_mods(MC_VERSION))
+    installed = {}
+    for mod in compatible:
+        roll = rng.random()
+        if roll < 0.7:
+            installed[mod.ID] = {"filename": f"{mod.ID}.jar", "hash": "0" * 32, "version": mod.version}
+        elif roll < 0.9:
+            installed[mod.ID] = {"filename": f"{mod.ID}-old.jar", "hash": "0" * 32, "version": "old"}
+
+    async def remove_installed(mods):
+        return await install_norisk_version.remove_installed_mods(mods, installed)
+
+    # remove_installed_mods updates the entries, every iteration gets fresh ones
+    cases["remove_installed_mods"] = (lambda: [copy.copy(mod) for mod in compatible], remove_installed)
+
+    histories = [make_version_history(args.history) for _ in range(args.projects)]
+    # the wanted version is spread over the whole history
+    wanted = [history[rng.randrange(len(history))]["version_number"] for history in histories]
+
+    async def match_versions(_):
+        return [modrinth.match_version(history, number) for history, number in zip(histories, wanted)]
+
+    cases["modrinth.match_version"] = (lambda: None, match_versions)
+
+    maven_mods = [mod for mod in compatible if mod.source_type == "maven"]
+
+    async def maven_urls(_):
+        return [await install_norisk_version.build_maven_url(mod, repos) for mod in maven_mods]
+
+    cases["build_maven_url"] = (lambda: None, maven_urls)
+    return cases
+
+
+async def run_case(setup, run, runs:int) -> dict:
+    times = []
+    for _ in range(runs):
+        arg = setup()
+        start = time.perf_counter()
+        await run(arg)
+        times.append(time.perf_counter() - start)
+
+    arg = setup()
+    tracemalloc.start()
+    await run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_ms": statistics.median(times) * 1000, "min_ms": min(times) * 1000, "peak_kib": peak / 1024}
+
+
+def compare(results:dict, baseline:dict, max_regression:float|None) -> bool:
+    '''
+    Prints the change against the baseline
+
+    Returns:
+        False if a case got slower than max_regression percent
+    '''
+    ok = True
+    print(f"\n{'case':<36} {'baseline':>10} {'now':>10} {'change':>8}")
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<36} {'-':>10} {result['median_ms']:9.2f}ms {'new':>8}")
+            continue
+        change = (result["median_ms"] / old["median_ms"] - 1) * 100 if old["median_ms"] else 0.0
+        flag = ""
+        if max_regression is not None and change > max_regression:
+            flag = "  FAIL"
+            ok = False
+        print(f"{name:<36} {old['median_ms']:9.2f}ms {result['median_ms']:9.2f}ms {change:+7.1f}%{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets", type=int, default=3000, help="files in the synthetic asset tree")
+    parser.add_argument("--max-asset-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--mods", type=int, default=200, help="jars in the fake mods folder")
+    parser.add_argument("--modpack-mods", type=int, default=2000, help="mods in the synthetic modpacks payload")
+    parser.add_argument("--projects", type=int, default=200, help="modrinth projects to match versions for")
+    parser.add_argument("--history", type=int, default=500, help="versions per modrinth project")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", nargs="*", help="only run cases starting with one of these names")
+    parser.add_argument("--save", type=Path, help="write the results as a baseline")
+    parser.add_argument("--baseline", type=Path, help="compare against a saved baseline")
+    parser.add_argument("--max-regression", type=float, default=None, help="fail if a case is this many percent slower than the baseline")
+    args = parser.parse_args()
+
+    print(f"building fixtures in {os.getcwd()}")
+    cases = build_cases(args)
+    if args.only:
+        cases = {name: case for name, case in cases.items() if name.startswith(tuple(args.only))}
+
+    results = {}
+    print(f"{'case':<36} {'median':>10} {'min':>10} {'peak mem':>12}")
+    for name, (setup, run) in cases.items():
+        result = asyncio.run(run_case(setup, run, args.runs))
+        results[name] = result
+        print(f"{name:<36} {result['median_ms']:9.2f}ms {result['min_ms']:9.2f}ms {result['peak_kib']:9.0f} KiB")
+
+    if args.save:
+        with open(CWD / args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nbaseline written to {args.save}")
+    ok = True
+    if args.baseline:
+        with open(CWD / args.baseline) as f:
+            ok = compare(results, json.load(f), args.max_regression)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+'''
+Measures parse time, peak RSS and the memory that stays allocated for the two
+big metadata documents (the asset pack metadata and the modpacks document) on
+large synthetic payloads.
+
+Every variant runs in its own interpreter so the peak RSS of one does not
+hide the next. Reading the body is part of every variant, a download has to
+be held in memory whole unless it is streamed:
+    full     decoded and json.loads'ed, the whole document is kept (how it used to be)
+    view     json.loads, reduced to the compact view right away
+    orjson   like view but parsed with orjson (skipped if not installed)
+    ijson    the view is built with ijson while the body streams in (skipped if not installed)
+    cached   the marshalled view from the http cache is loaded
+
+usage: python benchmarks/bench_manifest.py [--assets N] [--mods N] [--versions N] [--runs N]
+'''
+import argparse
+import asyncio
+import gc
+import json
+import marshal
+import os
+from pathlib import Path
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+VARIANTS = ["full", "view", "orjson", "ijson", "cached"]
+# the version the modpacks view is built for, the first one make_modpacks generates
+MC_VERSION = "1.8.0"
+
+
+def make_asset_metadata(assets:int, seed:int=0) -> dict:
+    '''
+    Creates pack metadata shaped like the one of the norisk api
+    '''
+    rng = random.Random(seed)
+    objects = {}
+    for i in range(assets):
+        path = f"assets/nrc/textures/cosmetics/{i % 97}/{i:07d}.png"
+        objects[path] = {"hash": rng.randbytes(16).hex(), "size": rng.randrange(100, 2_000_000)}
+    return {"id": "norisk-prod", "objects": objects}
+
+
+def make_modpacks(mods:int, versions:int, seed:int=0) -> dict:
+    '''
+    Creates a modpacks document with a few packs, every mod listing versions compatibility entries
+    '''
+    rng = random.Random(seed)
+    mc_versions = [f"1.{major}.{minor}" for major in range(8, 22) for minor in range(6)][:versions]
+    packs = {}
+    for pack in ["norisk-prod", "norisk-dev", "norisk-bughunter", "norisk-legacy"]:
+        pack_mods = []
+        for i in range(mods):
+            compatibility = {
+                v: {"fabric": {"identifier": f"{i}.{rng.randrange(20)}.0+{v}"}, "forge": None}
+                for v in mc_versions
+            }
+            if i % 2:
+                source = {"type": "modrinth", "projectId": f"proj{i:05d}"}
+            else:
+                source = {"type": "maven", "repositoryRef": "norisk", "groupId": f"gg.norisk.mod{i % 17}", "artifactId": f"mod{i}"}
+            pack_mods.append({
+                "id": f"mod{i}",
+                "displayName": f"Mod {i}",
+                "description": "x" * rng.randrange(50, 300),
+                "compatibility": compatibility,
+                "source": source,
+            })
+        packs[pack] = {"displayName": pack, "mods": pack_mods}
+    return {"packs": packs, "repositories": {"norisk": "https://maven.norisk.gg/repository/norisk-production/"}}
+
+
+def rss_kb() -> int:
+    '''
+    Returns the peak resident size of this process
+    '''
+    # ru_maxrss survives exec on linux, it would report the peak of the parent
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class AsyncFile():
+    '''
+    Minimal stand-in for a response body stream
+    '''
+    def __init__(self, path:str):
+        self.f = open(path, "rb")
+
+    async def read(self, n:int=-1) -> bytes:
+        return self.f.read(n)
+
+
+def child(variant:str, doc:str, path:str):
+    # the api module reads the config relative to the cwd on import
+    os.chdir(tempfile.mkdtemp(prefix="nrc-bench-"))
+    sys.path.insert(0, str(SRC))
+    import networking.api as api
+    import networking.http_cache as http_cache
+    def view():
+        # a view is filled once
+        return api.AssetObjects() if doc == "assets" else api.NoriskProdMods(MC_VERSION)
+
+    def read():
+        with open(path, "rb") as f:
+            return f.read()
+
+    def parse():
+        if variant == "full":
+            return json.loads(read().decode())
+        if variant == "view":
+            return http_cache.apply_view(view(), json.loads(read()))
+        if variant == "orjson":
+            import orjson
+            return http_cache.apply_view(view(), orjson.loads(read()))
+        if variant == "ijson":
+            return asyncio.run(http_cache.stream_view(view(), AsyncFile(path)))[0]
+        return marshal.loads(read())
+
+    before = rss_kb()
+    start = time.perf_counter()
+    data = parse()
+    elapsed = time.perf_counter() - start
+    peak = rss_kb()
+
+    # freed memory is not always given back to the os, the kept size is traced in a second parse
+    del data
+    gc.collect()
+    tracemalloc.start()
+    data = parse()
+    gc.collect()
+    kept, _ = tracemalloc.get_traced_memory()
+    print(json.dumps({"seconds": elapsed, "peak_kb": peak - before, "kept_kb": kept / 1024}))
+
+
+def run(variant:str, doc:str, path:Path) -> dict:
+    out = subprocess.run(
+        [sys.executable, __file__, "--child", variant, doc, str(path)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets", type=int, default=300_000, help="objects in the asset metadata")
+    parser.add_argument("--mods", type=int, default=400, help="mods per pack in the modpacks document")
+    parser.add_argument("--versions", type=int, default=60, help="minecraft versions per mod")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+        return
+
+    for module in ("orjson", "ijson"):
+        try:
+            __import__(module)
+        except ImportError:
+            VARIANTS.remove(module)
+
+    tmp = Path(tempfile.mkdtemp(prefix="nrc-bench-"))
+    try:
+        sys.path.insert(0, str(SRC))
+        docs = {
+            "assets": make_asset_metadata(args.assets, args.seed),
+            "modpacks": make_modpacks(args.mods, args.versions, args.seed),
+        }
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        import networking.api as api
+        import networking.http_cache as http_cache
+        os.chdir(cwd)
+        views = {"assets": api.AssetObjects(), "modpacks": api.NoriskProdMods(MC_VERSION)}
+
+        print(f"{'document':<10} {'variant':<8} {'size':>9} {'parse':>9} {'peak rss':>10} {'kept':>9}")
+        for name, doc in docs.items():
+            raw_path = tmp / f"{name}.json"
+            raw_path.write_text(json.dumps(doc))
+            cached_path = tmp / f"{name}.marshal"
+            cached_path.write_bytes(marshal.dumps(http_cache.apply_view(views[name], doc)))
+            for variant in VARIANTS:
+                path = cached_path if variant == "cached" else raw_path
+                results = [run(variant, name, path) for _ in range(args.runs)]
+                seconds = statistics.median(result["seconds"] for result in results)
+                peak = statistics.median(result["peak_kb"] for result in results)
+                kept = statistics.median(result["kept_kb"] for result in results)
+                print(
+                    f"{name:<10} {variant:<8} {path.stat().st_size / 1024 / 1024:>7.1f}MB "
+                    f"{seconds * 1000:>7.1f}ms {peak / 1024:>8.1f}MB {kept / 1024:>7.1f}MB"
+                )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''
+Measures the import time of the wrapper with `python -X importtime` and fails
+if it exceeds a budget or if a module that should be imported lazily shows up.
+
+usage: python benchmarks/bench_startup.py [--max-ms MS] [--runs N] [--top N]
+'''
+import argparse
+import ast
+from pathlib import Path
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+
+
+def main_imports() -> list:
+    '''
+    Reads the module level imports of __main__, everything it imports before the first network request
+
+    Returns:
+        list of module names
+    '''
+    tree = ast.parse((SRC / "__main__.py").read_text())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules.append(node.module)
+    return modules
+
+
+IMPORTS = main_imports()
+# only imported on the code paths that need them
+LAZY_MODULES = ["duckdb", "jwt", "requests", "httpx"]
+
+LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure() -> list:
+    '''
+    Runs one interpreter that imports the wrapper modules
+
+    Returns:
+        list of (module, self_us, cumulative_us, depth)
+    '''
+    code = f"import sys; sys.path.insert(0, {str(SRC)!r}); " + "; ".join(f"import {m}" for m in IMPORTS)
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=cwd, capture_output=True, text=True
+        )
+    if result.returncode != 0:
+        sys.exit(f"importing the wrapper failed:\n{result.stderr}")
+    modules = []
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--max-ms", type=float, default=None, help="fail if the median import time is above this")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    totals = []
+    for _ in range(args.runs):
+        modules = measure()
+        totals.append(sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1000)
+    median = statistics.median(totals)
+
+    print(f"import time: median {median:.1f} ms, min {min(totals):.1f} ms over {args.runs} runs")
+    print(f"slowest top level imports (last run):")
+    top_level = sorted((m for m in modules if m[3] == 0), key=lambda m: m[2], reverse=True)
+    for name, _, cumulative, _ in top_level[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    imported = {name.split(".")[0] for name, *_ in modules}
+    for module in LAZY_MODULES:
+        if module in imported:
+            print(f"FAIL: {module} is imported at startup but should be imported lazily")
+            failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"FAIL: median import time {median:.1f} ms exceeds the budget of {args.max_ms} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,567 @@
+#!/usr/bin/env python3
+'''
+End-to-end launch simulator. Starts local stand-ins for the Norisk API and
+CDN, Mojang's session server, Modrinth and a Maven repository and runs the
+real wrapper (token flow and download_data) against them in subprocesses,
+with os.execvp replaced by a stub that reports the launch time.
+
+Scenarios:
+    cold        fresh instance, empty cache, no stored token
+    warm        the same instance again, nothing changed
+    update      the same instance after some assets and mods changed upstream
+    lost-index  the same instance after its mod index (.nrc-index.json) was deleted
+    plan        changes upstream again, runs `plan` on the same instance and then
+                launches it, printing the planned next to the actual downloads
+    concurrent  --instances fresh instances launched at the same time,
+                sharing one cache and one prism data dir
+    prefetch    one `prefetch` run over --instances fresh instances
+                (prefetched: launching them afterwards)
+
+Latency, bandwidth (per service), error rate (503 with Retry-After) and
+dropped connections apply to the file downloads, the metadata and auth
+endpoints only get the latency.
+
+usage: python benchmarks/sim_launch.py [--assets N] [--mods N] [--latency S]
+           [--bandwidth BYTES/S] [--error-rate P] [--drop-rate P]
+           [--instances N] [--scenarios NAME ...] [--json FILE] [--keep] [--trace]
+'''
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from aiohttp import web
+
+SRC = Path(__file__).resolve().parent.parent / "src"
+RESULT_PREFIX = "SIM_RESULT "
+MC_VERSION = "1.21.4"
+CHUNK_SIZE = 16 * 1024
+SCENARIOS = ["cold", "warm", "update", "lost-index", "plan", "concurrent", "prefetch"]
+
+
+def fake_token(lifetime:int=7 * 24 * 3600) -> str:
+    '''
+    Creates an unsigned jwt, the wrapper only reads the expiry
+    '''
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    return f"{part({'alg': 'HS256', 'typ': 'JWT'})}.{part({'exp': int(time.time()) + lifetime})}.c2ln"
+
+
+class Link():
+    '''
+    Shared bandwidth of one service, chunks are sent in fifo order
+    '''
+
+    def __init__(self, bandwidth:float|None):
+        self.bandwidth = bandwidth
+        self.next_free = 0.0
+
+    async def send(self, size:int):
+        if not self.bandwidth:
+            return
+        now = time.monotonic()
+        self.next_free = max(now, self.next_free) + size / self.bandwidth
+        await asyncio.sleep(self.next_free - now)
+
+
+class Services():
+    '''
+    Generates the pack contents and serves them like the real services
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.links = {}
+        self.stats = {}
+        self.urls = {}
+        self.assets = {}
+        for i in range(args.assets):
+            ext = ".json" if i % 10 == 0 else ".png" if i % 10 < 8 else ".ogg"
+            self.assets[f"nrc-cosmetics/assets/noriskclient/sim/{i % 50}/asset{i}{ext}"] = self._asset_body()
+        self.mods = {}
+        for i in range(args.mods):
+            mod_id = f"mod{i}"
+            source = "modrinth" if i % 2 else "maven"
+            self.mods[mod_id] = {"source": source, "project": f"P{i:05d}", "versions": ["1.0.0"]}
+        self.jars = {}
+
+    def _asset_body(self) -> bytes:
+        return self.rng.randbytes(max(1, int(self.rng.lognormvariate(0, 1.2) * self.args.asset_size)))
+
+    def jar(self, mod_id:str, version:str) -> bytes:
+        key = (mod_id, version)
+        if key not in self.jars:
+            rng = random.Random(f"{self.args.seed}-{mod_id}-{version}")
+            self.jars[key] = rng.randbytes(max(1, int(rng.lognormvariate(0, 0.8) * self.args.jar_size)))
+        return self.jars[key]
+
+    def update(self):
+        '''
+        Changes some assets and bumps some mod versions
+        '''
+        for path in self.rng.sample(sorted(self.assets), min(self.args.update_assets, len(self.assets))):
+            self.assets[path] = self._asset_body()
+        for mod_id in self.rng.sample(sorted(self.mods), min(self.args.update_mods, len(self.mods))):
+            versions = self.mods[mod_id]["versions"]
+            versions.append(f"1.{len(versions)}.0")
+
+    def reset_stats(self):
+        for name in self.stats:
+            self.stats[name] = {"requests": 0, "bytes": 0, "errors": 0, "drops": 0}
+
+    # payloads
+
+    def modpacks(self) -> dict:
+        mods = []
+        for mod_id, mod in self.mods.items():
+            if mod["source"] == "modrinth":
+                source = {"type": "modrinth", "projectId": mod["project"]}
+            else:
+                source = {"type": "maven", "repositoryRef": "sim", "groupId": "gg.norisk.sim", "artifactId": mod_id}
+            mods.append({
+                "id": mod_id,
+                "compatibility": {MC_VERSION: {"fabric": {"identifier": mod["versions"][-1]}}},
+                "source": source,
+            })
+        return {"packs": {"norisk-prod": {"mods": mods}}, "repositories": {"sim": f"{self.urls['maven']}/"}}
+
+    def pack(self) -> dict:
+        return {"objects": {
+            path: {"hash": hashlib.md5(body).hexdigest(), "size": len(body)} for path, body in self.assets.items()
+        }}
+
+    def _modrinth_mods(self):
+        return {mod["project"]: (mod_id, mod) for mod_id, mod in self.mods.items() if mod["source"] == "modrinth"}
+
+    def project(self, mod_id:str, mod:dict) -> dict:
+        return {"id": mod["project"], "slug": mod_id, "versions": [f"{mod['project']}-{v}" for v in mod["versions"]]}
+
+    def version(self, mod_id:str, mod:dict, version:str) -> dict:
+        filename = f"{mod_id}-{version}.jar"
+        return {
+            "id": f"{mod['project']}-{version}",
+            "version_number": version,
+            "loaders": ["fabric"],
+            "files": [{
+                "url": f"{self.urls['modrinth']}/data/{mod_id}/{version}/{filename}",
+                "filename": filename,
+                "primary": True,
+                "size": len(self.jar(mod_id, version)),
+                "hashes": {"sha1": hashlib.sha1(self.jar(mod_id, version)).hexdigest()},
+            }],
+        }
+
+    # request handling
+
+    async def _begin(self, request, name:str, faulty:bool=False):
+        '''
+        Applies latency and (for file downloads) injected errors
+
+        Returns:
+            an error response or None
+        '''
+        stats = self.stats[name]
+        stats["requests"] += 1
+        await asyncio.sleep(self.args.latency)
+        if faulty and self.rng.random() < self.args.error_rate:
+            stats["errors"] += 1
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return None
+
+    def _json(self, request, name:str, data) -> web.Response:
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        self.stats[name]["bytes"] += len(body)
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def _file(self, request, name:str, body:bytes) -> web.StreamResponse:
+        error = await self._begin(request, name, faulty=True)
+        if error is not None:
+            return error
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        start = 0
+        status = 200
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        range_header = request.headers.get("Range", "")
+        if range_header.startswith("bytes=") and request.headers.get("If-Range", etag) == etag:
+            start = int(range_header[6:].split("-", 1)[0])
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(body) - start
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        drop_at = None
+        if self.rng.random() < self.args.drop_rate:
+            drop_at = start + (len(body) - start) // 2
+            self.stats[name]["drops"] += 1
+        link = self.links[name]
+        for offset in range(start, len(body), CHUNK_SIZE):
+            chunk = body[offset:offset + CHUNK_SIZE]
+            if drop_at is not None and offset + len(chunk) > drop_at:
+                request.transport.close()
+                return response
+            await link.send(len(chunk))
+            await response.write(chunk)
+            self.stats[name]["bytes"] += len(chunk)
+        await response.write_eof()
+        return response
+
+    async def norisk_modpacks(self, request):
+        await self._begin(request, "norisk_api")
+        return self._json(request, "norisk_api", self.modpacks())
+
+    async def norisk_pack(self, request):
+        await self._begin(request, "norisk_api")
+        return self._json(request, "norisk_api", self.pack())
+
+    async def norisk_server_id(self, request):
+        await self._begin(request, "norisk_api")
+        return web.json_response({"serverId": hashlib.sha1(os.urandom(8)).hexdigest()})
+
+    async def norisk_validate(self, request):
+        await self._begin(request, "norisk_api")
+        return web.json_response({"value": fake_token()})
+
+    async def cdn_asset(self, request):
+        body = self.assets.get(request.match_info["path"])
+        if body is None:
+            raise web.HTTPNotFound()
+        return await self._file(request, "cdn", body)
+
+    async def mojang_join(self, request):
+        await self._begin(request, "mojang")
+        return web.Response(status=204)
+
+    async def modrinth_projects(self, request):
+        await self._begin(request, "modrinth")
+        by_project = self._modrinth_mods()
+        by_slug = {mod_id: (mod_id, mod) for mod_id, mod in by_project.values()}
+        projects = {}
+        for key in json.loads(request.query["ids"]):
+            found = by_project.get(key) or by_slug.get(key)
+            if found:
+                project = self.project(*found)
+                projects[project["id"]] = project
+        return self._json(request, "modrinth", list(projects.values()))
+
+    async def modrinth_versions(self, request):
+        await self._begin(request, "modrinth")
+        by_project = self._modrinth_mods()
+        versions = []
+        for version_id in json.loads(request.query["ids"]):
+            project, _, version = version_id.partition("-")
+            if project in by_project:
+                mod_id, mod = by_project[project]
+                if version in mod["versions"]:
+                    versions.append(self.version(mod_id, mod, version))
+        return self._json(request, "modrinth", versions)
+
+    async def modrinth_file(self, request):
+        mod = self.mods.get(request.match_info["mod"])
+        if mod is None or request.match_info["version"] not in mod["versions"]:
+            raise web.HTTPNotFound()
+        return await self._file(request, "modrinth", self.jar(request.match_info["mod"], request.match_info["version"]))
+
+    async def maven_file(self, request):
+        mod_id, version = request.match_info["artifact"], request.match_info["version"]
+        mod = self.mods.get(mod_id)
+        if mod is None or version not in mod["versions"]:
+            raise web.HTTPNotFound()
+        if request.match_info["filename"].endswith(".sha1"):
+            await self._begin(request, "maven")
+            return web.Response(text=hashlib.sha1(self.jar(mod_id, version)).hexdigest())
+        return await self._file(request, "maven", self.jar(mod_id, version))
+
+    async def start(self) -> list:
+        '''
+        Starts every service on its own port, so each one is a separate host for the wrapper
+        '''
+        routes = {
+            "norisk_api": [
+                web.get("/api/v1/launcher/modpacks", self.norisk_modpacks),
+                web.get("/api/v1/launcher/pack/{asset_id}", self.norisk_pack),
+                web.post("/api/v1/launcher/auth/request-server-id", self.norisk_server_id),
+                web.post("/api/v1/launcher/auth/validate/v2", self.norisk_validate),
+            ],
+            "cdn": [web.get("/assets/{asset_id}/assets/{path:.+}", self.cdn_asset)],
+            "mojang": [web.post("/session/minecraft/join", self.mojang_join)],
+            "modrinth": [
+                web.get("/v2/projects", self.modrinth_projects),
+                web.get("/v2/versions", self.modrinth_versions),
+                web.get("/data/{mod}/{version}/{filename}", self.modrinth_file),
+            ],
+            "maven": [web.get("/gg/norisk/sim/{artifact}/{version}/{filename}", self.maven_file)],
+        }
+        prefixes = {"norisk_api": "/api/v1", "cdn": "/assets", "mojang": "", "modrinth": "/v2", "maven": ""}
+        runners = []
+        for name, service_routes in routes.items():
+            app = web.Application()
+            app.add_routes(service_routes)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            host, port = runner.addresses[0][:2]
+            self.urls[name] = f"http://{host}:{port}{prefixes[name]}"
+            self.links[name] = Link(self.args.bandwidth)
+            self.stats[name] = {}
+            runners.append(runner)
+        self.urls["modrinth"] = self.urls["modrinth"].removesuffix("/v2")
+        self.reset_stats()
+        return runners
+
+
+def make_instance(root:Path, name:str) -> Path:
+    '''
+    Creates a prism style instance, the wrapper runs in its minecraft dir
+    '''
+    instance = root / "instances" / name
+    (instance / "minecraft").mkdir(parents=True, exist_ok=True)
+    with open(instance / "mmc-pack.json", "w") as f:
+        json.dump({"components": [{"uid": "net.minecraft", "version": MC_VERSION}]}, f)
+    return instance / "minecraft"
+
+
+def make_prism_dir(path:Path) -> Path:
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / "accounts.json", "w") as f:
+        json.dump({"accounts": [{
+            "active": True,
+            "ygg": {"token": "sim-minecraft-token"},
+            "profile": {"name": "Simulated", "id": "0123456789abcdef0123456789abcdef"},
+        }]}, f)
+    return path
+
+
+async def launch(spec:dict, log:Path) -> dict:
+    '''
+    Runs one wrapper launch in a subprocess
+
+    Returns:
+        result:dict | ok, wall time and what the wrapper reported
+    '''
+    start = time.perf_counter()
+    with open(log, "ab") as f:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, __file__, "--child", json.dumps(spec),
+            stdout=asyncio.subprocess.PIPE, stderr=f
+        )
+        stdout, _ = await process.communicate()
+    result = {"ok": False}
+    for line in stdout.decode().splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+    result["wall"] = time.perf_counter() - start
+    result["returncode"] = process.returncode
+    return result
+
+
+async def run_scenario(name:str, services:Services, specs:list, log:Path) -> dict:
+    services.reset_stats()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(launch(spec, log) for spec in specs))
+    elapsed = time.perf_counter() - start
+    walls = [r["wall"] for r in results]
+    summary = {
+        "scenario": name,
+        "instances": len(results),
+        "failed": sum(not r["ok"] for r in results),
+        "elapsed": elapsed,
+        "wall_median": statistics.median(walls),
+        "wall_max": max(walls),
+        "wrapper_median": statistics.median(r.get("wrapper", 0) for r in results),
+        "requests": sum(s["requests"] for s in services.stats.values()),
+        "bytes": sum(s["bytes"] for s in services.stats.values()),
+        "errors": sum(s["errors"] for s in services.stats.values()),
+        "drops": sum(s["drops"] for s in services.stats.values()),
+        "services": json.loads(json.dumps(services.stats)),
+    }
+    print(
+        f"{name:<11} {summary['instances']:>4} {summary['failed']:>6} {summary['wall_median']:9.2f}s "
+        f"{summary['wall_max']:9.2f}s {summary['wrapper_median']:9.2f}s {summary['requests']:>9} "
+        f"{summary['bytes'] / 1e6:9.1f}MB {summary['errors']:>6} {summary['drops']:>6}"
+    )
+    return summary
+
+
+async def simulate(args) -> list:
+    root = Path(tempfile.mkdtemp(prefix="nrc-sim-"))
+    log = root / "wrapper.log"
+    services = Services(args)
+    runners = await services.start()
+    print(f"{args.assets} assets, {args.mods} mods, latency {args.latency * 1000:.0f} ms, "
+          f"bandwidth {args.bandwidth / 1e6 if args.bandwidth else 0:.1f} MB/s per service, "
+          f"error rate {args.error_rate:.0%}, drop rate {args.drop_rate:.0%}")
+    print(f"work dir {root}, wrapper logs in {log}\n")
+    print(f"{'scenario':<11} {'inst':>4} {'failed':>6} {'median':>10} {'max':>10} {'wrapper':>10} {'requests':>9} {'served':>11} {'503s':>6} {'drops':>6}")
+
+    def spec(instance:Path, cache:Path, prism:Path) -> dict:
+        return {
+            "instance": str(instance), "cache": str(cache), "prism": str(prism),
+            "urls": services.urls, "metadata_ttl": args.metadata_ttl, "trace": args.trace,
+        }
+
+    summaries = []
+    try:
+        single = spec(make_instance(root, "single"), root / "cache-single", make_prism_dir(root / "prism-single"))
+        for scenario in args.scenarios:
+            if scenario == "cold":
+                summaries.append(await run_scenario("cold", services, [single], log))
+            elif scenario == "warm":
+                summaries.append(await run_scenario("warm", services, [single], log))
+            elif scenario == "update":
+                services.update()
+                summaries.append(await run_scenario("update", services, [single], log))
+            elif scenario == "lost-index":
+                (Path(single["instance"]) / ".nrc-index.json").unlink(missing_ok=True)
+                summaries.append(await run_scenario("lost-index", services, [single], log))
+            elif scenario == "plan":
+                services.update()
+                planned = await launch(dict(single, plan=True), log)
+                summary = await run_scenario("plan", services, [single], log)
+                summaries.append(summary)
+                if planned.get("plan"):
+                    print(f"{'':<11} planned {planned['plan']['requests']} downloads / {planned['plan']['bytes'] / 1e6:.1f}MB, "
+                          f"{planned['plan']['unknown_sizes']} without size")
+                else:
+                    print(f"{'':<11} plan failed, see {log}")
+            elif scenario == "concurrent":
+                prism = make_prism_dir(root / "prism-shared")
+                specs = [
+                    spec(make_instance(root, f"concurrent-{i}"), root / "cache-shared", prism)
+                    for i in range(args.instances)
+                ]
+                summaries.append(await run_scenario("concurrent", services, specs, log))
+            elif scenario == "prefetch":
+                prism = make_prism_dir(root / "prism-prefetch")
+                specs = []
+                for i in range(args.instances):
+                    instance = make_instance(prism, f"prefetch-{i}")
+                    with open(instance.parent / "instance.cfg", "w") as f:
+                        f.write(f"[General]\nname=prefetch-{i}\nOverrideCommands=true\nWrapperCommand=python {SRC}\n")
+                    specs.append(spec(instance, root / "cache-prefetch", prism))
+                prefetch_spec = dict(spec(prism, root / "cache-prefetch", prism), prefetch=True)
+                summaries.append(await run_scenario("prefetch", services, [prefetch_spec], log))
+                summaries.append(await run_scenario("prefetched", services, specs, log))
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    if any(s["failed"] for s in summaries):
+        print("\nsome launches failed" + (f", see {log}" if args.keep else ", rerun with --keep to inspect the logs"))
+    return summaries
+
+
+def child(spec:dict):
+    '''
+    Runs the wrapper in this process against the simulated services
+    '''
+    start = time.perf_counter()
+    sys.path.insert(0, str(SRC))
+    os.chdir(spec["instance"])
+    import config
+    config.LAUNCHER = "prism"
+    config.PRISM_DATA_DIR = spec["prism"]
+    config.CACHE_DIR = Path(spec["cache"])
+    config.METADATA_TTL = spec["metadata_ttl"]
+    config.REMOVE_WATERMARK = False
+    config.INSTANT_LAUNCH = False
+    config.TRACE = spec["trace"]
+    # the exec stub below replaces the game, the relay would try to run it
+    config.LOG_RELAY = False
+    config.GAME_LOG_LEVEL = None
+    import networking.api as api
+    import networking.client as client
+    import networking.modrinth_api as modrinth
+    urls = spec["urls"]
+    api.NORISK_API_URL = urls["norisk_api"]
+    api.NORISK_CDN_URL = urls["cdn"]
+    api.MOJANG_SESSION_URL = urls["mojang"]
+    modrinth.BASE_URL = f"{urls['modrinth']}/v2"
+
+    import importlib.util
+    module_spec = importlib.util.spec_from_file_location("nrc_wrapper", SRC / "__main__.py")
+    wrapper = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(wrapper)
+
+    def fake_exec(file, args):
+        result = {"ok": True, "wrapper": time.perf_counter() - start, "client": dict(client.stats)}
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        os._exit(0)
+
+    os.execvp = fake_exec
+    # detached jobs would run without the patched urls
+    wrapper.start_detached = lambda arg, log_name: None
+    if spec.get("plan"):
+        output = Path(spec["instance"]) / ".nrc-plan.json"
+        sys.argv = [str(SRC / "__main__.py"), "plan", "-o", str(output)]
+        wrapper.main()
+        with open(output) as f:
+            plan = json.load(f)
+        output.unlink()
+        result = {"ok": True, "wrapper": time.perf_counter() - start, "plan": plan["summary"]}
+        print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return
+    if spec.get("prefetch"):
+        sys.argv = [
+            str(SRC / "__main__.py"), "prefetch",
+            "--prism-dir", spec["prism"], "--modrinth-db", str(Path(spec["prism"]) / "app.db")
+        ]
+        try:
+            wrapper.main()
+        except SystemExit as e:
+            result = {"ok": not e.code, "wrapper": time.perf_counter() - start, "client": dict(client.stats)}
+            print(RESULT_PREFIX + json.dumps(result), flush=True)
+        return
+    sys.argv = [str(SRC / "__main__.py"), "java", "-cp", "client.jar", "net.minecraft.client.main.Main"]
+    wrapper.main()
+
+
+def main():
+    if sys.argv[1:2] == ["--child"]:
+        child(json.loads(sys.argv[2]))
+        return
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets", type=int, default=1000)
+    parser.add_argument("--asset-size", type=int, default=16 * 1024, help="median asset size in bytes")
+    parser.add_argument("--mods", type=int, default=40)
+    parser.add_argument("--jar-size", type=int, default=512 * 1024, help="median jar size in bytes")
+    parser.add_argument("--latency", type=float, default=0.03, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes/s per service, unlimited if not set")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of file downloads answered with 503")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of file downloads cut off halfway")
+    parser.add_argument("--update-assets", type=int, default=50, help="assets changed before the update scenario")
+    parser.add_argument("--update-mods", type=int, default=3, help="mods bumped before the update scenario")
+    parser.add_argument("--metadata-ttl", type=float, default=0, help="metadata_ttl of the simulated wrapper")
+    parser.add_argument("--instances", type=int, default=4, help="instances of the concurrent scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, help="write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the work dir and logs")
+    parser.add_argument("--trace", action="store_true", help="write a trace per launch into the cache dirs (use with --keep)")
+    args = parser.parse_args()
+
+    summaries = asyncio.run(simulate(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()}, "results": summaries}, f, indent=2)
+    sys.exit(1 if any(s["failed"] for s in summaries) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,31 +14,222 @@ from shutil import which
 import tasks.get_token as get_token
 import tasks.get_assets as get_assets
 import tasks.install_norisk_version as install_norisk_version
+import tasks.prefetch as prefetch
+import tasks.sync_plan as sync_plan
+import networking.client as client
+import utils.staging as staging
+import utils.tracing as tracing
+import utils.log_relay as log_relay
+from utils.task_graph import TaskGraph
+import config
 
 # Wrapper script for the NoRisk instance.
 # Prism Launcher will call this script with the original Java command as arguments.
 # This script adds the -D property, downloads assets, mods and then runs the command.
 
-os.makedirs("./mods",exist_ok=True)
+# arguments the wrapper passes to itself to run detached background jobs
+BACKGROUND_UPDATE_ARG = "--nrc-background-update"
+REFRESH_TOKEN_ARG = "--nrc-refresh-token"
+# subcommand for running the wrapper by hand/from cron instead of from a launcher
+PREFETCH_COMMAND = "prefetch"
+PLAN_COMMAND = "plan"
 
-async def download_data(token):
+async def download_assets(token, asset_plan):
+    if not token:
+        return False
+    return await get_assets.execute(token, asset_plan)
+
+async def mark_complete(mc_version, _, assets_complete):
+    if assets_complete:
+        staging.write_state(mc_version)
+    return assets_complete
+
+async def download_data():
+    '''
+    Gets the token and syncs assets and mods on one event loop
+
+    Everything that does not need the token(version detection, planning
+    the jars and assets, jar downloads) runs alongside the token
+    acquisition, only the authenticated asset downloads wait for it.
+
+    Returns:
+        token:str|None
+        complete:bool | True if the instance is completely installed
+    '''
+    graph = TaskGraph()
+    graph.add("token", get_token.main)
+    graph.add("mc_version", install_norisk_version.get_mc_version)
+    graph.add("mods_plan", install_norisk_version.plan, deps=("mc_version",))
+    graph.add("mods", install_norisk_version.execute, deps=("mods_plan",))
+    graph.add("asset_plan", get_assets.plan)
+    graph.add("asset_download", download_assets, deps=("token", "asset_plan"))
+    graph.add("state", mark_complete, deps=("mc_version", "mods", "asset_download"))
+    results = await graph.run()
+    return results["token"], results["state"]
+
+async def get_instant_launch_token():
+    '''
+    Checks if the instance can be started without syncing first
+
+    Returns:
+        a valid stored token if the instance was completely verified for
+        the current minecraft version, None otherwise
+    '''
+    state = staging.read_state()
+    if not state or state.get("mc_version") != await install_norisk_version.get_mc_version():
+        return None
+    return await get_token.get_stored_token()
+
+def start_detached(arg:str, log_name:str):
+    '''
+    Starts a detached copy of the wrapper that outlives the launch
+
+    Args:
+        arg: job argument the copy is started with
+        log_name: file in the staging dir the output goes to
+    '''
+    staging.STAGING_PATH.mkdir(exist_ok=True)
+    log = open(staging.STAGING_PATH / log_name, "w")
+    if sys.platform == "win32":
+        kwargs = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        kwargs = {"start_new_session": True}
+    subprocess.Popen(
+        [sys.executable, sys.argv[0], arg],
+        stdin=subprocess.DEVNULL,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        **kwargs
+    )
+
+def start_background_update():
+    '''
+    Starts a detached copy of the wrapper that stages updates for the next launch
+    '''
+    start_detached(BACKGROUND_UPDATE_ARG, "update.log")
+    logger.info("Started background updater")
+
+def start_token_refresh():
+    '''
+    Starts a detached copy of the wrapper that renews the soon expiring token
+    '''
+    start_detached(REFRESH_TOKEN_ARG, "token-refresh.log")
+    logger.info("Started background token refresh")
 
-    tasks =[
-        get_assets.main(token),
-        install_norisk_version.main()
+async def background_update():
+    '''
+    Downloads updates into the staging area, they are applied on the next start
+    '''
+    if not staging.acquire_lock():
+        logger.info("Another update is already running")
+        return
+    try:
+        staging.recover()
+        staging.discard()
+        staging.enabled = True
+        _, complete = await download_data()
+        if complete:
+            staging.commit()
+        else:
+            logger.warning("Update incomplete, nothing staged")
+        if get_token.refresh_due:
+            # already running detached, no need for another process
+            await get_token.refresh()
+    finally:
+        staging.enabled = False
+        staging.release_lock()
+
+async def prefetch_instances(args):
+    '''
+    Syncs every NRC instance so its next launch has nothing to download
+
+    The jars of every minecraft version and the assets are downloaded into
+    the shared store in one pass, then every instance stages its update
+    from the store like the background updater does.
+
+    Returns:
+        True if everything was prefetched
+    '''
+    instances = prefetch.discover_prism(args.prism_dir) + prefetch.discover_modrinth(args.modrinth_db)
+    instances = [instance for instance in instances if instance.mc_version]
+    if not instances:
+        logger.info("No NRC instances found")
+        return True
+    versions = sorted({instance.mc_version for instance in instances})
+    logger.info(f"Found {len(instances)} NRC instances for minecraft {', '.join(versions)}")
+
+    complete = True
+    if config.USE_SHARED_STORE:
+        prefetch.enter(instances[0], args.prism_dir, args.modrinth_db)
+        try:
+            token = await get_token.main()
+        except Exception as e:
+            logger.warning(f"Failed to get a norisk token: {e}")
+            token = None
+        complete = await prefetch.fill_store(versions, token)
 
-    ]
-    await asyncio.gather(*tasks)
+    for instance in instances:
+        logger.info(f"Syncing {instance.name} ({instance.mc_version})")
+        try:
+            prefetch.enter(instance, args.prism_dir, args.modrinth_db)
+            with tracing.span(f"sync {instance.name}", "prefetch"):
+                await background_update()
+        except Exception as e:
+            logger.error(f"Failed to sync {instance.name}: {e}")
+            complete = False
+    return complete
+
+async def prepare_launch():
+    '''
+    Makes the instance ready to start
+
+    Returns:
+        token:str|None
+    '''
+    if config.INSTANT_LAUNCH:
+        token = await get_instant_launch_token()
+        if token:
+            logger.info("Instant launch: starting with the verified installation, updates are applied next launch")
+            start_background_update()
+            return token
+    token, _ = await download_data()
+    if get_token.refresh_due:
+        start_token_refresh()
+    return token
 
 def main():
+    if sys.argv[1:2] == [PREFETCH_COMMAND]:
+        args = prefetch.parse_args(sys.argv[2:])
+        complete = asyncio.run(client.scoped(prefetch_instances(args)))
+        tracing.write("prefetch")
+        sys.exit(0 if complete else 1)
+
+    os.makedirs("./mods",exist_ok=True)
+    if sys.argv[1:2] == [PLAN_COMMAND]:
+        args = sync_plan.parse_args(sys.argv[2:])
+        plan = asyncio.run(client.scoped(sync_plan.make(sizes=not args.no_head)))
+        sync_plan.write(plan, args.output, args.objects)
+        return
+    if sys.argv[1:] == [BACKGROUND_UPDATE_ARG]:
+        asyncio.run(client.scoped(background_update()))
+        tracing.write("background-update")
+        return
+    if sys.argv[1:] == [REFRESH_TOKEN_ARG]:
+        asyncio.run(client.scoped(get_token.refresh()))
+        return
+
+    with tracing.span("apply staged updates"):
+        staging.recover()
+        staging.apply_pending()
+
+    with tracing.span("prepare launch"):
+        token = asyncio.run(client.scoped(prepare_launch()))
+    tracing.write("launch")
     # Check if the token is set. Exit with an error if it's not.
-    token = asyncio.run(get_token.main())
     if not token:
         print("ERROR: Missing Norisk token", file=sys.stderr)
         sys.exit(1)
 
-    asyncio.run(download_data(token))
-
     # Get the original command arguments
     original_args = sys.argv[1:]
     
@@ -64,25 +255,10 @@ def main():
         new_cmd.append(f"-Dnorisk.token={token}")
     # Execute
     try:
-        # windows log output workaround(i hate you billie)
-        # TODO for some reason the log reading is very slow and wierd but at least it works
-        if sys.platform == "win32":
-            logger.warning("Using Windows log stream workaround... the log may be slow")
-            process = subprocess.Popen(
-                new_cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1,
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-            )
-            while True:
-                output = process.stdout.readline()
-                if output == '' and process.poll() is not None:
-                    break
-                if output:
-                    print(output.strip())
-            sys.exit(process.returncode)
+        # windows has no exec that keeps the launcher's log stream(i hate you billie),
+        # the wrapper stays alive and relays the output there or when configured
+        if log_relay.use_relay():
+            sys.exit(log_relay.main(new_cmd))
         else:
             logger.info("Starting Minecraft..")
             os.execvp(new_cmd[0], new_cmd)
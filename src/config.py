@@ -1,7 +1,9 @@
 
 import json5
+import os
 from pathlib import Path
 import logging
+import sys
 
 logger = logging.getLogger("Config")
 
@@ -17,7 +19,25 @@ default_config = '''\
     //TODO DOES NOT WORK CURRENTLY(force install newest mod versions) 
     "force_newest_mods": false,
     // forces launcher type(mostly used vor development) "null" to disable
-    "force_launcher_type": null
+    "force_launcher_type": null,
+    // share downloaded assets and jars between all instances(hardlinked/copied from one global store)
+    "use_shared_store": true,
+    // where the shared store and other caches are kept, "null" for the default user cache dir
+    "cache_dir": null,
+    // seconds the cached pack/modpack/modrinth metadata is used without asking the server if it changed
+    "metadata_ttl": 300,
+    // start minecraft right away if the instance was verified before, updates are
+    // downloaded in the background and applied on the next launch
+    "instant_launch": false,
+    // write a trace of every launch (phases, requests, downloads, hashing) to <cache_dir>/traces,
+    // open it in chrome://tracing or ui.perfetto.dev
+    "trace": false,
+    // keep the wrapper running and relay the game output instead of replacing the wrapper
+    // process with the game(always used on windows)
+    "log_relay": false,
+    // also write the game output to NoRiskClient/game-logs as rotating .gz files, keeping lines
+    // at or above this level("DEBUG", "INFO", "WARN", "ERROR"), "null" to disable. implies log_relay
+    "game_log_level": null
 }
     '''
 
@@ -33,6 +53,18 @@ def get_config()-> dict:
 
     return config
 
+def default_cache_dir() -> Path:
+    '''
+    Returns the platform specific user cache directory for the wrapper
+    '''
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or Path.home() / "AppData" / "Local"
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "nrc-wrapper"
+
 c = get_config()
 
 LAUNCHER = c.get("force_launcher_type")
@@ -40,6 +72,13 @@ MODRINTH_DATA_PATH = c.get("modrinth_data_dir")
 REMOVE_WATERMARK = c.get("remove_watermark")
 PRISM_DATA_DIR = c.get("prism_data_dir")
 FORCE_NEWEST_MODS = c.get("force_newest_mods")
+USE_SHARED_STORE = c.get("use_shared_store", True)
+CACHE_DIR = Path(c.get("cache_dir") or default_cache_dir()).expanduser()
+METADATA_TTL = c.get("metadata_ttl", 300)
+INSTANT_LAUNCH = c.get("instant_launch", False)
+TRACE = c.get("trace", False)
+LOG_RELAY = c.get("log_relay", False)
+GAME_LOG_LEVEL = c.get("game_log_level")
 
 if not LAUNCHER:
     if Path(MODRINTH_DATA_PATH).is_file():
@@ -1,14 +1,16 @@
 import asyncio
 import hashlib
 import logging
-import os
 from pathlib import Path
 import platform
+import time
 from typing import Dict
 import uuid
-import aiofiles
 import aiohttp
-import httpx
+import networking.client as client
+import networking.download as download
+import networking.http_cache as http_cache
+import networking.scheduler as scheduler
 
 
 logger = logging.getLogger("Minecraft/Norisk API")
@@ -16,136 +18,199 @@ logger = logging.getLogger("Minecraft/Norisk API")
 ASSET_PATH = "NoRiskClient/assets"
 MOJANG_SESSION_URL = "https://sessionserver.mojang.com"
 NORISK_API_URL = "https://api.norisk.gg/api/v1"
-concurrent_downloads = 10
+NORISK_CDN_URL = "https://cdn.norisk.gg/assets"
+# assets the client needs while loading, they are downloaded before the rest
+CRITICAL_ASSET_SUFFIXES = (".json", ".mcmeta")
 
-async def download_jar(download_url,filename):
-    """Downloads jar file from given url"""
+async def download_jar(download_url,filename,dest=None,size=None,expected_hash=None,algorithm="md5"):
+    """
+    Downloads jar file from given url to dest(defaults to ./mods/filename)
+
+    Returns:
+        hex digest(algorithm, md5 by default) of the downloaded jar, a dict if algorithm is a tuple(see stream_download)
+    """
     logger = logging.getLogger("Mod Downloader")
     logger.info(f"Downloading {filename} 🙏")
-    async with asyncio.Semaphore(concurrent_downloads):
+    try:
+        digest = await download.stream_download(
+            download_url, dest or f"./mods/{filename}", expected_hash, algorithm, priority=scheduler.JAR, size=size
+        )
+        logger.info(f"Downloaded {filename} ✅")
+        return digest
+    except aiohttp.ClientResponseError as e:
+        if e.status == 404:
+            logger.exception(f"file not found: {download_url}")
+            raise Exception(f"file not found: {download_url}")
+        else:
+            logger.exception(f"HTTP error: {e}")
+            raise Exception(f"HTTP error: {e}")
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        raise Exception(f"Unexpected error: {e}")
+
+
+async def download_single_asset(asset_id: str, path: str, asset_info: Dict,norisk_token: str, dest=None) -> None:
+        """Download a single asset file to dest(defaults to its place in ASSET_PATH)"""
+        logger = logging.getLogger("Asset Downloader")
         try:
-            async with aiohttp.ClientSession() as client:
-                async with client.get(download_url) as response:
-                    response.raise_for_status()
-                    async with aiofiles.open(f"./mods/{filename}", 'wb') as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            await f.write(chunk)
-                        logger.info(f"Downloaded {filename} ✅")
-                        return True
-        except aiohttp.ClientResponseError as e:
-            if e.status == 404:
-                logger.exception(f"file not found: {download_url}")
-                raise Exception(f"file not found: {download_url}")
-            else:
-                logger.exception(f"HTTP error: {e}")
-                raise Exception(f"HTTP error: {e}")
+            path_obj = Path(path)
+            
+            # Download from CDN, hashed while streaming and only moved into place if it matches
+            url = f"{NORISK_CDN_URL}/{asset_id}/assets/{path}"
+            headers = {"Authorization": f"Bearer {norisk_token}"}
+            priority = scheduler.CRITICAL_ASSET if path.endswith(CRITICAL_ASSET_SUFFIXES) else scheduler.ASSET
+            logger.debug(f"Downloading: {path_obj.name}")
+            await download.stream_download(
+                url, dest or f"{ASSET_PATH}/{path}", asset_info.get("hash"), headers=headers,
+                priority=priority, size=asset_info.get("size")
+            )
+                        
         except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            raise Exception(f"Unexpected error: {e}")
+            logger.error(f"Error downloading {path}: {e} URL:{url}")
+            raise
 
 
-async def download_single_asset(asset_id: str, path: str, asset_info: Dict,norisk_token: str, semaphore: asyncio.Semaphore) -> None:
-        """Download a single asset file"""
-        logger = logging.getLogger("Asset Downloader")
-        async with semaphore:
-            try:
-                path_obj = Path(path)
-                dir_path = path_obj.parent
-                os.makedirs(f"{ASSET_PATH}/{dir_path}", exist_ok=True)
-                
-                # Download from CDN
-                url = f"https://cdn.norisk.gg/assets/{asset_id}/assets/{path}"
-                headers = {"Authorization": f"Bearer {norisk_token}"}
-                logger.info(f"Downloading: {path_obj.name}")
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers) as response:
-                        if response.status == 200:
-                            content = await response.read()
-                            
-                            # Verify hash
-                            downloaded_hash = hashlib.md5(content).hexdigest()
-                            if downloaded_hash != asset_info.get("hash"):
-                                raise ValueError(f"Hash mismatch for {path}")
-                                
-                            # Save file
-                            async with aiofiles.open(f"{ASSET_PATH}/{path}", "wb") as f:
-                                await f.write(content)
-                                
-                        else:
-                            raise Exception(f"Failed to download {path}: {response.status}")
-                            
-            except Exception as e:
-                print(f"Error downloading {path}: {e} URL:{url}")
-                raise
 
+async def get_maven_checksum(url, algorithm="sha1"):
+    """
+    Gets the checksum a maven repository publishes next to an artifact (url.sha1)
+
+    Released artifacts never change, so the checksum is cached after the first request.
 
+    Returns:
+        hex digest or None if the repository has no usable checksum
+    """
+    sidecar = f"{url}.{algorithm}"
+    _, cached = http_cache.read_entry(sidecar)
+    if cached:
+        return cached
+    try:
+        async with scheduler.get_scheduler().slot(sidecar, scheduler.META) as slot, client.get_session().get(sidecar) as response:
+            slot.response(response)
+            if not response.ok:
+                logger.debug(f"no {algorithm} checksum for {url}: {response.status}")
+                return None
+            text = await response.text()
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"failed to get {algorithm} checksum for {url}: {e}")
+        return None
+    # "<digest>" or "<digest>  <filename>"
+    digest = next(iter(text.split()), "").lower()
+    if len(digest) != hashlib.new(algorithm).digest_size * 2 or digest.strip("0123456789abcdef"):
+        logger.debug(f"invalid {algorithm} checksum for {url}")
+        return None
+    if "SNAPSHOT" not in url:
+        http_cache.write_entry(sidecar, {"checked": time.time()}, digest)
+    return digest
+
+async def get_content_length(url):
+    """
+    Gets the size of a download with a HEAD request
+
+    Released artifacts never change, so the size is cached after the first request.
+
+    Returns:
+        size in bytes or None if the server does not tell
+    """
+    key = f"HEAD {url}"
+    _, cached = http_cache.read_entry(key)
+    if cached:
+        return cached
+    try:
+        async with scheduler.get_scheduler().slot(url, scheduler.META) as slot, \
+                client.get_session().head(url, allow_redirects=True) as response:
+            slot.response(response)
+            if not response.ok:
+                logger.debug(f"HEAD {url} failed: {response.status}")
+                return None
+            length = response.content_length
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"HEAD {url} failed: {e}")
+        return None
+    if length and "SNAPSHOT" not in url:
+        http_cache.write_entry(key, {"checked": time.time()}, length)
+    return length
+
+class AssetObjects(http_cache.View):
+    """
+    Reduces pack metadata to path -> (md5, size), nothing else of the document is used
+    """
+    name = "objects"
+    selectors = (("objects", True),)
+
+    def __init__(self):
+        self.objects = {}
+
+    def add(self, prefix, member):
+        path, info = member
+        self.objects[path] = (info.get("hash"), info.get("size"))
+
+    def result(self):
+        return self.objects
 
 async def get_asset_metadata(asset_id):
-    url = f"https://api.norisk.gg/api/v1/launcher/pack/{asset_id}"
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as response:
-                logger.info(response.status)
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    logger.warning(f"Failed to fetch assets: {response.status}")
-                    return {}
-        except Exception as e:
-            logger.exception(f"Error fetching assets: {e}")
-            return {}
-        except asyncio.TimeoutError:
-            logger.error("Request timed out")
-            return {}
-        except aiohttp.ClientError as e:
-            logger.exception(f"HTTP client error: {e}")
-            return {}
-        except Exception as e:
-            logger.exception(f"Unexpected error: {e}")
-            return {}
+    """
+    Gets the assets of a pack
+
+    Returns:
+        objects:dict | path -> (md5, size), empty if the request failed
+    """
+    url = f"{NORISK_API_URL}/launcher/pack/{asset_id}"
+    try:
+        return await http_cache.get_json(url, view=AssetObjects())
+    except aiohttp.ClientResponseError as e:
+        logger.warning(f"Failed to fetch assets: {e.status}")
+        return {}
+    except asyncio.TimeoutError:
+        logger.error("Request timed out")
+        return {}
+    except aiohttp.ClientError as e:
+        logger.exception(f"HTTP client error: {e}")
+        return {}
+    except Exception as e:
+        logger.exception(f"Unexpected error: {e}")
+        return {}
 
 async def validate_with_norisk_api(username,server_id):
     url = f"{NORISK_API_URL}/launcher/auth/validate/v2"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                url,
-                params={
-                    "force": False,
-                    "hwid": hashlib.md5(f"{platform.node()}{uuid.getnode()}{platform.machine()}".encode()).hexdigest(),
-                    "username": username,
-                    "server_id": server_id
-                }
-            )
-            if not response.is_success:
-                error_text = response.text
+    try:
+        async with scheduler.get_scheduler().slot(url, scheduler.META) as slot, client.get_session().post(
+            url,
+            params={
+                "force": "false",
+                "hwid": hashlib.md5(f"{platform.node()}{uuid.getnode()}{platform.machine()}".encode()).hexdigest(),
+                "username": username,
+                "server_id": server_id
+            }
+        ) as response:
+            slot.response(response)
+            if not response.ok:
+                error_text = await response.text()
                 logger.debug(f"failed to validate server join with norisk api: {error_text}")
                 raise Exception(f"failed to validate server join with norisk api: {error_text}")
-            return response.json().get("value")
-            
-        except httpx.RequestError as e:
-            logger.debug(f"API request failed: {e}")
-            raise Exception(f"Norisk API request failed: {e}")
+            return (await response.json(content_type=None)).get("value")
+        
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"API request failed: {e}")
+        raise Exception(f"Norisk API request failed: {e}")
 
 
 async def request_server_id():
     url = f"{NORISK_API_URL}/launcher/auth/request-server-id"
-    async with httpx.AsyncClient() as client:
-        logger.debug("[API]")
-        
-        try:
-            response = await client.post(
-                    url
-                )
-            if not response.is_success:
-                error_text = response.text
+    logger.debug("[API]")
+    
+    try:
+        async with scheduler.get_scheduler().slot(url, scheduler.META) as slot, client.get_session().post(url) as response:
+            slot.response(response)
+            if not response.ok:
+                error_text = await response.text()
                 logger.debug(f"failed to get server_id from norisk api: {error_text}")
                 raise Exception(f"failed to get server_id from norisk api: {error_text}")
             
-            return response.json().get("serverId")
-        except httpx.RequestError as e:
-            logger.debug(f"Norisk API request failed: {e}")
-            raise Exception(f"Norisk API request failed: {e}")
+            return (await response.json(content_type=None)).get("serverId")
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"Norisk API request failed: {e}")
+        raise Exception(f"Norisk API request failed: {e}")
 
 
 async def join_server_session(
@@ -175,45 +240,80 @@ async def join_server_session(
 
     logger.debug(f"Join request - selected_profile: {selected_profile}, server_id: {server_id}")
 
-    async with httpx.AsyncClient() as client:
-        logger.debug("Sending join server request to Minecraft Session API")
-        
-        try:
-            response = await client.post(
-                url,
-                headers={"Content-Type": "application/json"},
-                json=join_request
-            )
-            
-            logger.debug(f"Received response with status: {response.status_code}")
+    logger.debug("Sending join server request to Minecraft Session API")
+    
+    try:
+        async with scheduler.get_scheduler().slot(url, scheduler.META) as slot, client.get_session().post(
+            url,
+            headers={"Content-Type": "application/json"},
+            json=join_request
+        ) as response:
+            slot.response(response)
+            logger.debug(f"Received response with status: {response.status}")
 
-            if not response.is_success:
-                error_text = response.text
+            if not response.ok:
+                error_text = await response.text()
                 logger.debug(f"Join server session failed: {error_text}")
                 raise Exception(f"Failed to join server session: {error_text}")
             
             logger.debug("API call completed: join_server_session - Successfully joined server session")
-            
-        except httpx.RequestError as e:
-            logger.debug(f"API request failed: {e}")
-            raise Exception(f"Minecraft API request failed: {e}")
+        
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"API request failed: {e}")
+        raise Exception(f"Minecraft API request failed: {e}")
         
 
-async def get_norisk_versions():
+class NoriskProdMods(http_cache.View):
+    """
+    Reduces the modpacks document(every pack with every compatibility entry) to the norisk-prod mods for one mc_version
+
+    Result:
+        mods:list | (id, fabric identifier, source type, repositoryRef, groupId, projectId, artifactId),
+            only mods with a fabric build for mc_version
+        repositories:dict | repository refrences
+    """
+    selectors = (("packs.norisk-prod.mods.item", False), ("repositories", False))
+
+    def __init__(self, mc_version):
+        self.name = f"norisk-prod/{mc_version}"
+        self.mc_version = mc_version
+        self.mods = []
+        self.repositories = None
+
+    def add(self, prefix, value):
+        if prefix == "repositories":
+            self.repositories = value
+            return
+        compatibility = (value.get("compatibility") or {}).get(self.mc_version)
+        fabric = compatibility.get("fabric") if compatibility else None
+        identifier = fabric.get("identifier") if fabric else None
+        if not identifier:
+            return
+        source = value.get("source")
+        self.mods.append((
+            value.get("id"),
+            identifier,
+            source.get("type"),
+            source.get("repositoryRef"),
+            source.get("groupId"),
+            source.get("projectId"),
+            source.get("artifactId")
+        ))
+
+    def result(self):
+        return {"mods": self.mods, "repositories": self.repositories}
+
+async def get_norisk_versions(mc_version):
+    """
+    Gets the mods of the norisk-prod pack for mc_version, see NoriskProdMods
+    """
     url = f"{NORISK_API_URL}/launcher/modpacks"
-    async with httpx.AsyncClient() as client:
-        logger.info("Getting version profiles from norisk api")
-        try:
-            response = await client.get(
-                url
-            )
-            
-            if not response.is_success:
-                error_text = response.text
-                logger.debug(f"failed to get version profiles from norisk api: {error_text}")
-                raise Exception(f"failed to get version profiles from norisk api: {error_text}")
-            
-            return response.json()
-        except httpx.RequestError as e:
-            logger.debug(f"Norisk API request failed: {e}")
-            raise Exception(f"Norisk API request failed: {e}")
\ No newline at end of file
+    logger.info("Getting version profiles from norisk api")
+    try:
+        return await http_cache.get_json(url, view=NoriskProdMods(mc_version))
+    except aiohttp.ClientResponseError as e:
+        logger.debug(f"failed to get version profiles from norisk api: {e.status} {e.message}")
+        raise Exception(f"failed to get version profiles from norisk api: {e.status} {e.message}")
+    except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+        logger.debug(f"Norisk API request failed: {e}")
+        raise Exception(f"Norisk API request failed: {e}")
\ No newline at end of file
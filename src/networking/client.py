@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import aiohttp
+import utils.tracing as tracing
+
+logger = logging.getLogger("HTTP Client")
+
+# one timeout policy for every request the wrapper makes
+TIMEOUT = aiohttp.ClientTimeout(total=None, connect=15, sock_connect=15, sock_read=60)
+CONNECTION_LIMIT = 64
+CONNECTION_LIMIT_PER_HOST = 16
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+stats = {
+    "requests": 0,
+    "connections_created": 0,
+    "connections_reused": 0,
+    "dns_cache_hits": 0,
+    "dns_cache_misses": 0,
+}
+
+_session: aiohttp.ClientSession|None = None
+_session_loop = None
+
+
+def _trace_config() -> aiohttp.TraceConfig:
+    '''
+    Builds a TraceConfig that counts requests and connection reuse
+    '''
+    trace = aiohttp.TraceConfig()
+
+    def count(key):
+        async def handler(session, context, params):
+            stats[key] += 1
+        return handler
+
+    trace.on_request_start.append(count("requests"))
+    trace.on_connection_create_end.append(count("connections_created"))
+    trace.on_connection_reuseconn.append(count("connections_reused"))
+    trace.on_dns_cache_hit.append(count("dns_cache_hits"))
+    trace.on_dns_cache_miss.append(count("dns_cache_misses"))
+    return trace
+
+
+def _tracing_config() -> aiohttp.TraceConfig:
+    '''
+    Builds a TraceConfig that records a span from sending each request to its
+    response headers, and one per new connection (dns, tcp and tls)
+    '''
+    trace = aiohttp.TraceConfig()
+
+    async def request_start(session, context, params):
+        context.span = tracing.span(f"{params.method} {params.url.host}{params.url.path}", "http", url=str(params.url))
+        context.span.__enter__()
+
+    async def request_end(session, context, params):
+        context.span.set(status=params.response.status, bytes=params.response.content_length)
+        context.span.__exit__(None, None, None)
+
+    async def request_exception(session, context, params):
+        context.span.__exit__(type(params.exception), params.exception, None)
+
+    async def connection_start(session, context, params):
+        context.connection_span = tracing.span("connect", "http")
+        context.connection_span.__enter__()
+
+    async def connection_end(session, context, params):
+        context.connection_span.__exit__(None, None, None)
+
+    trace.on_request_start.append(request_start)
+    trace.on_request_end.append(request_end)
+    trace.on_request_exception.append(request_exception)
+    trace.on_connection_create_start.append(connection_start)
+    trace.on_connection_create_end.append(connection_end)
+    return trace
+
+
+def get_session() -> aiohttp.ClientSession:
+    '''
+    Returns the launch-scoped client session, creating it on first use
+
+    All api functions share this session so connections to the same host
+    are kept alive and reused instead of doing a new TCP/TLS handshake per request.
+    '''
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        _session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=TIMEOUT,
+            trace_configs=[_trace_config()] + ([_tracing_config()] if tracing.enabled else []),
+        )
+        _session_loop = loop
+    return _session
+
+
+def log_stats():
+    '''
+    Logs connection reuse statistics of the shared session
+    '''
+    created = stats["connections_created"]
+    reused = stats["connections_reused"]
+    if not stats["requests"]:
+        return
+    logger.info(
+        f"{stats['requests']} requests over {created} connections "
+        f"({reused} reused, {reused / max(created + reused, 1):.0%} reuse rate)"
+    )
+
+
+async def close():
+    '''
+    Closes the shared session and reports its statistics
+    '''
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        log_stats()
+    _session = None
+
+
+async def scoped(coro):
+    '''
+    Awaits coro and closes the shared session afterwards
+
+    Args:
+        coro: coroutine that uses the shared session
+    '''
+    try:
+        return await coro
+    finally:
+        await close()
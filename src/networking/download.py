@@ -0,0 +1,287 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import aiofiles
+import aiohttp
+import networking.client as client
+import networking.scheduler as scheduler
+import utils.file_lock as file_lock
+import utils.hashing as hashing
+import utils.store as store
+import utils.tracing as tracing
+
+logger = logging.getLogger("Downloader")
+
+CHUNK_SIZE = 64 * 1024
+# smaller downloads are simply restarted, not worth keeping state for
+RESUME_MIN_SIZE = 1024 * 1024
+# how often the progress of a resumable download is persisted
+CHECKPOINT_BYTES = 4 * 1024 * 1024
+# attempts per call, every attempt after the first resumes where the last one stopped
+# (small or unresumable downloads start over)
+RESUME_ATTEMPTS = 5
+# pause before the second attempt, doubled for every further one
+RETRY_DELAY = 0.2
+# how long a download waits for another process that fetches the same store object
+SHARED_WAIT_TIMEOUT = 10 * 60
+# errors where the connection broke, the partial data is still good
+RETRYABLE_ERRORS = (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+_temp_ids = itertools.count()
+
+
+def preallocate(fd:int, size:int):
+    '''
+    Reserves size bytes for the file behind fd so it is written without fragmentation
+
+    Args:
+        fd: file descriptor
+        size: expected file size in bytes
+    '''
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not supported on this platform/filesystem
+        pass
+
+
+def _unlock(fd, path:Path):
+    if fd is None:
+        return
+    # unlinked while still held, try_lock re-checks the inode after locking
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    file_lock.unlock(fd)
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _read_resume_state(state_path:Path, url:str) -> dict|None:
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if state.get("url") != url:
+        return None
+    return state
+
+
+def _write_resume_state(state_path:Path, state:dict):
+    tmp = state_path.with_name(f"{state_path.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path)
+
+
+def _hash_prefix(path:Path, length:int, algorithms:tuple) -> list:
+    '''
+    Hashes the first length bytes of a file with every algorithm (blocking)
+    '''
+    digests = [hashlib.new(algorithm) for algorithm in algorithms]
+    remaining = length
+    with open(path, "rb") as f:
+        while remaining:
+            chunk = f.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise IOError(f"{path} is shorter than {length} bytes")
+            for digest in digests:
+                digest.update(chunk)
+            remaining -= len(chunk)
+    return digests
+
+
+def _content_range_start(header:str|None) -> int|None:
+    # "bytes 100-199/200"
+    try:
+        return int(header.split(" ", 1)[1].split("-", 1)[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+async def _attempt(url:str, part:Path, state_path:Path|None, algorithms:tuple, headers:dict|None, slot):
+    '''
+    One download attempt into part, resuming from the saved state if there is one
+
+    Returns:
+        digest objects of the complete file, one per algorithm
+    '''
+    state = _read_resume_state(state_path, url) if state_path else None
+    offset = 0
+    # aiohttp decodes compressed bodies, Content-Length and ranges would count the encoded bytes
+    request_headers = {"Accept-Encoding": "identity", **(headers or {})}
+    if state and part.is_file():
+        offset = min(state.get("offset", 0), part.stat().st_size)
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            request_headers["If-Range"] = state["validator"]
+
+    async with client.get_session().get(url, headers=request_headers) as response:
+        slot.response(response)
+        response.raise_for_status()
+        # servers may compress anyway, the decoded size is not known then
+        encoded = response.headers.get("Content-Encoding", "identity").lower() != "identity"
+        length = None if encoded else response.content_length
+        if offset and not encoded and response.status == 206 and _content_range_start(response.headers.get("Content-Range")) == offset:
+            logger.info(f"Resuming {part.name} at {offset} bytes")
+            tracing.instant("resume", "download", offset=offset)
+            digests = await asyncio.to_thread(_hash_prefix, part, offset, algorithms)
+            total = offset + length if length is not None else None
+            mode = "r+b"
+        else:
+            if offset:
+                logger.info(f"Server ignored the range request for {part.name}, downloading from the start")
+            offset = 0
+            digests = [hashlib.new(algorithm) for algorithm in algorithms]
+            total = length
+            mode = "wb"
+
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+        resumable = (
+            state_path is not None and not encoded and validator and total and total >= RESUME_MIN_SIZE
+            and (response.status == 206 or response.headers.get("Accept-Ranges") == "bytes")
+        )
+        if resumable:
+            state = {"url": url, "size": total, "validator": validator, "offset": offset}
+            _write_resume_state(state_path, state)
+        elif state_path is not None:
+            _remove(state_path)
+
+        written = offset
+        async with aiofiles.open(part, mode) as f:
+            if mode == "r+b":
+                await f.seek(offset)
+                await f.truncate()
+            if total:
+                await asyncio.to_thread(preallocate, f.fileno(), total)
+            try:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    for digest in digests:
+                        digest.update(chunk)
+                    await f.write(chunk)
+                    written += len(chunk)
+                    slot.progress(len(chunk))
+                    if resumable and written - state["offset"] >= CHECKPOINT_BYTES:
+                        await f.flush()
+                        state["offset"] = written
+                        _write_resume_state(state_path, state)
+                if total and written != total:
+                    raise aiohttp.ClientPayloadError(f"Incomplete download of {url}: got {written} of {total} bytes")
+            except RETRYABLE_ERRORS:
+                if resumable:
+                    await f.flush()
+                    state["offset"] = written
+                    _write_resume_state(state_path, state)
+                raise
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+    return digests
+
+
+async def stream_download(url:str, dest, expected_hash:str|None=None, algorithm:str|tuple="md5", headers:dict|None=None, priority:int=scheduler.ASSET, size:int|None=None) -> str|dict:
+    '''
+    Streams url to dest while hashing it, without keeping the body in memory
+
+    The data is written to a temporary file next to dest which is only
+    fsynced and renamed onto dest once the hash matches, so dest is never
+    left truncated or corrupted. For large files the progress is kept in
+    dest.part/dest.part.json, if the connection drops (now or in an earlier
+    launch) the download resumes with a Range request. If dest is a store
+    object that another process is downloading right now, that download is
+    waited for and used.
+
+    Args:
+        url: download url
+        dest: target path
+        expected_hash: hex digest the download has to match, not checked if None
+        algorithm: hashlib algorithm name, or a tuple of them to get several digests
+            in the same pass(expected_hash is checked against the first)
+        headers: extra request headers
+        priority: scheduler priority class
+        size: expected size if known, used by the scheduler
+
+    Returns:
+        digest:str | hex digest of the downloaded file, a dict algorithm -> hex digest if algorithm is a tuple
+    '''
+    algorithms = (algorithm,) if isinstance(algorithm, str) else tuple(algorithm)
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(f"{dest.name}.part")
+    lock_path = dest.with_name(f"{dest.name}.part.lock")
+    lock = file_lock.try_lock(lock_path)
+    shared = store.is_object(dest)
+    if lock is None and shared:
+        # another process (an instance launched at the same time) fetches the same object, wait for it
+        logger.info(f"Waiting for another download of {dest.name}")
+        with tracing.span(f"wait for {dest.name}", "download", url=url):
+            lock = await file_lock.lock(lock_path, SHARED_WAIT_TIMEOUT)
+    if lock is not None and shared and dest.is_file():
+        # finished by someone else, objects are only renamed into the store once their hash matched
+        _unlock(lock, lock_path)
+        if isinstance(algorithm, str) and expected_hash:
+            return expected_hash
+        hexdigests = await hashing.calc_hash(dest, algorithms)
+        return hexdigests[algorithms[0]] if isinstance(algorithm, str) else hexdigests
+    if lock is not None:
+        state_path = dest.with_name(f"{dest.name}.part.json")
+    else:
+        # someone else is downloading the same file right now, don't touch their partial
+        part = dest.with_name(f"{dest.name}.{os.getpid()}.{next(_temp_ids)}.part")
+        state_path = None
+
+    with tracing.span(f"download {dest.name}", "download", url=url, priority=priority) as span:
+        try:
+            for attempt in range(1, RESUME_ATTEMPTS + 1):
+                try:
+                    async with scheduler.get_scheduler().slot(url, priority, size) as slot:
+                        digests = await _attempt(url, part, state_path, algorithms, headers, slot)
+                    span.set(attempts=attempt)
+                    break
+                except scheduler.RateLimitedError as e:
+                    if attempt == RESUME_ATTEMPTS:
+                        raise
+                    logger.info(f"{e}, retrying {dest.name}")
+                    tracing.instant("retry", "download", reason="rate limited")
+                except RETRYABLE_ERRORS as e:
+                    resumable = state_path is not None and state_path.is_file()
+                    if attempt == RESUME_ATTEMPTS:
+                        if resumable:
+                            logger.warning(f"Download of {dest.name} interrupted, it will be resumed on the next launch")
+                        raise
+                    logger.warning(f"Download of {dest.name} interrupted ({e}), {'resuming' if resumable else 'restarting'}")
+                    tracing.instant("retry", "download", reason=type(e).__name__)
+                    await asyncio.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+            hexdigests = {name: digest.hexdigest() for name, digest in zip(algorithms, digests)}
+            hexdigest = hexdigests[algorithms[0]]
+            if expected_hash and hexdigest != expected_hash:
+                raise ValueError(f"Hash mismatch for {dest}: expected {expected_hash} got {hexdigest}")
+            os.replace(part, dest)
+            if state_path is not None:
+                _remove(state_path)
+            if tracing.enabled:
+                span.set(bytes=os.path.getsize(dest))
+            return hexdigest if isinstance(algorithm, str) else hexdigests
+        except (*RETRYABLE_ERRORS, scheduler.RateLimitedError):
+            if state_path is None or not state_path.is_file():
+                _remove(part)
+            raise
+        except BaseException:
+            _remove(part)
+            if state_path is not None:
+                _remove(state_path)
+            raise
+        finally:
+            _unlock(lock, lock_path)
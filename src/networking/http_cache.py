@@ -0,0 +1,252 @@
+import asyncio
+import hashlib
+import json
+import logging
+import marshal
+import os
+import time
+import aiohttp
+import config
+import networking.client as client
+import networking.scheduler as scheduler
+import utils.tracing as tracing
+
+try:
+    # optional, parses large documents several times faster
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+try:
+    # optional, views are built while the body streams in instead of from the parsed document
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger("HTTP Cache")
+
+CACHE_PATH = config.CACHE_DIR / "http"
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _paths(url:str):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return CACHE_PATH / f"{key}.json", CACHE_PATH / f"{key}.marshal"
+
+
+def _write_atomic(path, data:bytes):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def read_entry(url:str):
+    '''
+    Reads the cached validators and the pre-parsed body for url
+
+    Returns:
+        (meta:dict, body) or (None, None) if nothing usable is cached
+    '''
+    meta_path, body_path = _paths(url)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            body = marshal.load(f)
+    except (FileNotFoundError, ValueError, EOFError, TypeError):
+        return None, None
+    return meta, body
+
+
+def write_entry(url:str, meta:dict, body=None):
+    '''
+    Stores validators and (if given) the parsed body for url
+    '''
+    meta_path, body_path = _paths(url)
+    CACHE_PATH.mkdir(parents=True, exist_ok=True)
+    if body is not None:
+        _write_atomic(body_path, marshal.dumps(body))
+    _write_atomic(meta_path, json.dumps(meta).encode())
+
+
+class View():
+    '''
+    Reduces a json document to the parts a caller needs, only the result is kept
+
+    Subclasses list the parts in selectors as (prefix, members) pairs, the
+    prefix in ijson syntax("packs.norisk-prod.mods.item" are the elements of
+    that array). add is called with every value found at a prefix, or with
+    every (key, value) of the object there if members is set. A view is
+    filled once, pass a new instance to every get_json call.
+
+    With ijson installed only the selected values are ever built, while the
+    body streams in. Otherwise the whole document is parsed and walked.
+    '''
+    # part of the cache key, change it when the result changes(set per instance if the view has parameters)
+    name = None
+    selectors = ()
+
+    def add(self, prefix:str, value):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+def _select(doc, prefix:str) -> list:
+    values = [doc]
+    for part in prefix.split("."):
+        found = []
+        for value in values:
+            if part == "item" and isinstance(value, list):
+                found.extend(value)
+            elif isinstance(value, dict) and part in value:
+                found.append(value[part])
+        values = found
+    return values
+
+
+def _add(view:View, prefix:str, members:bool, value):
+    if not members:
+        view.add(prefix, value)
+    elif isinstance(value, dict):
+        for member in value.items():
+            view.add(prefix, member)
+
+
+def apply_view(view:View, doc):
+    '''
+    Fills a view from an already parsed document
+    '''
+    for prefix, members in view.selectors:
+        for value in _select(doc, prefix):
+            _add(view, prefix, members, value)
+    return view.result()
+
+
+class _CountingReader():
+    def __init__(self, body):
+        self.body = body
+        self.size = 0
+
+    async def read(self, n:int=-1) -> bytes:
+        chunk = await self.body.read(n)
+        self.size += len(chunk)
+        return chunk
+
+
+async def stream_view(view:View, body) -> tuple:
+    '''
+    Fills a view with ijson while the body streams in, only the selected values are ever built (needs ijson)
+
+    A single selector is matched by ijson itself. Several are matched in
+    one pass over the parse events, every selected value is built on its
+    own and handed to the view before the next one starts.
+
+    Args:
+        view: View instance
+        body: file like object with an async read(n), e.g. response.content
+
+    Returns:
+        (result, bytes read)
+    '''
+    reader = _CountingReader(body)
+    if len(view.selectors) == 1:
+        (prefix, members), = view.selectors
+        parser = ijson.kvitems_async if members else ijson.items_async
+        async for value in parser(reader, prefix, use_float=True, buf_size=STREAM_CHUNK_SIZE):
+            view.add(prefix, value)
+        return view.result(), reader.size
+
+    selectors = dict(view.selectors)
+    builder = None
+    current = None
+    async for prefix, event, value in ijson.parse_async(reader, use_float=True, buf_size=STREAM_CHUNK_SIZE):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == current and event in ("end_map", "end_array"):
+                _add(view, current, selectors[current], builder.value)
+                builder = None
+        elif prefix in selectors and event in ("start_map", "start_array"):
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+            current = prefix
+        elif prefix in selectors and event not in ("map_key", "end_map", "end_array"):
+            _add(view, prefix, selectors[prefix], value)
+    return view.result(), reader.size
+
+
+async def get_json(url:str, ttl:float|None=None, view:View|None=None):
+    '''
+    GETs a json document through the on-disk response cache
+
+    Within ttl seconds of the last check the cached copy is returned without
+    any request, after that it is revalidated with If-None-Match/If-Modified-Since
+    and a 304 is served from the pre-parsed local copy. gzip/deflate transfer
+    encoding is negotiated by the client session. If the request fails a stale
+    copy is used when there is one.
+
+    Args:
+        url: document url
+        ttl: freshness window in seconds, defaults to metadata_ttl from the config
+
+    Optional:
+        view=None| View instance that reduces the document to the parts the caller needs,
+        only its result is kept(in memory and in the cache)
+
+    Returns:
+        the parsed json document(or what view made of it)
+    '''
+    ttl = config.METADATA_TTL if ttl is None else ttl
+    # every view of a document is cached on its own, with its own validators
+    key = f"{url}#{view.name}" if view is not None else url
+    with tracing.span("get json", "metadata", url=url) as span:
+        meta, body = read_entry(key)
+        if meta is not None and time.time() - meta.get("checked", 0) < ttl:
+            logger.debug(f"Cache fresh: {url}")
+            span.set(cache="fresh")
+            return body
+
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        try:
+            async with scheduler.get_scheduler().slot(url, scheduler.META) as slot, \
+                    client.get_session().get(url, headers=headers) as response:
+                slot.response(response)
+                span.set(status=response.status)
+                if response.status == 304 and meta is not None:
+                    logger.debug(f"Cache revalidated: {url}")
+                    span.set(cache="revalidated")
+                    meta["checked"] = time.time()
+                    write_entry(key, meta)
+                    return body
+                response.raise_for_status()
+                if view is not None and ijson is not None:
+                    data, size = await stream_view(view, response.content)
+                    span.set(cache="miss", bytes=size, streamed=True)
+                else:
+                    raw = await response.read()
+                    span.set(cache="miss", bytes=len(raw))
+                    data = loads(raw)
+                    del raw
+                    if view is not None:
+                        data = apply_view(view, data)
+                write_entry(key, {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "checked": time.time(),
+                }, data)
+                return data
+        except (aiohttp.ClientError, asyncio.TimeoutError, scheduler.RateLimitedError) as e:
+            if meta is not None and not (isinstance(e, aiohttp.ClientResponseError) and e.status == 404):
+                logger.warning(f"Request to {url} failed ({e}), using cached copy")
+                span.set(cache="stale")
+                return body
+            raise
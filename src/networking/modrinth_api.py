@@ -1,42 +1,154 @@
-
-from asyncio import Semaphore
+import asyncio
+import json
 import logging
-import httpx
+from urllib.parse import quote
+import aiohttp
+import networking.http_cache as http_cache
+import utils.tracing as tracing
 from tenacity import retry, stop_after_attempt, wait_exponential
 
 logger = logging.getLogger("Modrinth API")
 
 
-semaphore = Semaphore(8)
 BASE_URL = "https://api.modrinth.com/v2"
+# ids per bulk request, keeps the url well below common proxy limits
+IDS_PER_REQUEST = 400
+# how many of the newest versions of each project are looked at per resolution round
+VERSIONS_PER_ROUND = 10
+# a published version never changes, so bulk version lookups can be cached for a long time
+VERSIONS_TTL = 24 * 60 * 60
+
+
+def _ids_param(ids) -> str:
+    return quote(json.dumps(sorted(ids), separators=(",", ":")))
+
 
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-async def get_versions(project,project_slug=None):
-    url = f"{BASE_URL}/project/{project}/version"
-    async with semaphore:
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.get(
-                    url
-                )
-                
-                if not response.is_success:
-                    error_text = response.text
-                    if project_slug:
-                        logger.info(f"failed to get versions for project {project} from modrinth api: {error_text} trying fallback")
-                        # fallback to project slug if it fails(mainly for ukulib ;3 since its the only mod having the wrong projectId from the norisk api)
-                        return await get_versions(project_slug)
-                    else:
-                        logger.exception(f"failed to get versions for project {project} from modrinth api: {error_text}")
-                        return None            
-                return {
-                    project: response.json()
-                }
-            except httpx.RequestError as e:
-                logger.debug(f"modrinth api request failed: {url} errot")
-                raise Exception(f"modrinth api request failed: {url}")
-            except httpx.TimeoutException as e:
-                logger.debug(f"modrinth api request Timeout: {url}")
-                raise Exception(f"modrinth api request Timeout: {url}")
-            
+async def _get_bulk(endpoint:str, ids:list, ttl:float|None=None) -> list:
+    url = f"{BASE_URL}/{endpoint}?ids={_ids_param(ids)}"
+    try:
+        return await http_cache.get_json(url, ttl)
+    except asyncio.TimeoutError as e:
+        logger.debug(f"modrinth api request Timeout: {url}")
+        raise Exception(f"modrinth api request Timeout: {url}")
+    except aiohttp.ClientError as e:
+        logger.debug(f"modrinth api request failed: {url} {e}")
+        raise Exception(f"modrinth api request failed: {url}")
+
+
+async def _get_bulk_chunked(endpoint:str, ids, ttl:float|None=None) -> list:
+    ids = sorted(set(ids))
+    chunks = [ids[i:i + IDS_PER_REQUEST] for i in range(0, len(ids), IDS_PER_REQUEST)]
+    results = await asyncio.gather(*(_get_bulk(endpoint, chunk, ttl) for chunk in chunks))
+    return [item for result in results for item in result]
+
+
+async def get_projects(ids) -> dict:
+    '''
+    Gets multiple projects in as few requests as possible
+
+    Args:
+        ids: project ids and/or slugs
+
+    Returns:
+        projects:dict | project id and slug -> project
+    '''
+    projects = {}
+    for project in await _get_bulk_chunked("projects", ids):
+        projects[project.get("id")] = project
+        projects[project.get("slug")] = project
+    return projects
+
+
+async def get_versions_bulk(version_ids) -> list:
+    '''
+    Gets multiple versions by id in as few requests as possible
+    '''
+    return await _get_bulk_chunked("versions", version_ids, VERSIONS_TTL)
+
+
+def match_version(versions, version_number:str, loader:str="fabric") -> dict|None:
+    '''
+    Finds the version with the given version number for a loader
+
+    Args:
+        versions: modrinth version objects
+        version_number: wanted version number
+        loader: mod loader the version has to support
+    '''
+    for v in versions:
+        if v.get("version_number") == version_number and loader in v.get("loaders", []):
+            return v
+    return None
+
+
+def primary_file(version:dict) -> dict|None:
+    '''
+    Returns the primary file of a version (the first file if none is flagged)
+    '''
+    files = version.get("files") or []
+    return next((file for file in files if file.get("primary")), files[0] if files else None)
+
+
+async def resolve_versions(wanted:list, loader:str="fabric") -> dict:
+    '''
+    Resolves version numbers of many projects to version objects using the bulk endpoints
+
+    The projects are fetched with one request, then the newest versions of all
+    unresolved projects are fetched together until every version is found,
+    usually one round. The slug is used as a fallback if a project id is not
+    found (mainly for ukulib ;3 since its the only mod having the wrong projectId from the norisk api).
+
+    Args:
+        wanted: list of (key, project_id, slug, version_number)
+        loader: mod loader the version has to support
+
+    Returns:
+        resolved:dict | key -> version object
+    '''
+    if not wanted:
+        return {}
+    with tracing.span("modrinth resolve", "mods", projects=len(wanted)) as span:
+        resolved, rounds = await _resolve_versions(wanted, loader)
+        span.set(resolved=len(resolved), rounds=rounds)
+    return resolved
+
+
+async def _resolve_versions(wanted:list, loader:str):
+    lookup = set()
+    for _, project_id, slug, _ in wanted:
+        lookup.add(project_id)
+        if slug:
+            lookup.add(slug)
+    projects = await get_projects(lookup)
+
+    pending = {}
+    for key, project_id, slug, version_number in wanted:
+        project = projects.get(project_id) or projects.get(slug)
+        if project is None:
+            logger.error(f"failed to find project {project_id} ({slug}) on modrinth")
+            continue
+        if project_id not in projects:
+            logger.info(f"project {project_id} not found on modrinth, using slug {slug}")
+        # newest versions first, the wanted one is usually among them
+        pending[key] = (version_number, list(reversed(project.get("versions", []))))
 
+    resolved = {}
+    rounds = 0
+    while pending:
+        rounds += 1
+        batch = {key: candidates[:VERSIONS_PER_ROUND] for key, (_, candidates) in pending.items()}
+        versions = await get_versions_bulk({vid for ids in batch.values() for vid in ids})
+        by_id = {v.get("id"): v for v in versions}
+        for key, ids in batch.items():
+            version_number, candidates = pending[key]
+            match = match_version((by_id[vid] for vid in ids if vid in by_id), version_number, loader)
+            if match is not None:
+                resolved[key] = match
+                del pending[key]
+            elif len(candidates) <= len(ids):
+                logger.error(f"no {loader} version {version_number} found for {key}")
+                del pending[key]
+            else:
+                pending[key] = (version_number, candidates[len(ids):])
+    return resolved, rounds
@@ -0,0 +1,297 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from urllib.parse import urlsplit
+import networking.client as client
+import utils.tracing as tracing
+
+logger = logging.getLogger("Download Scheduler")
+
+# priority classes, lower goes first
+META = 0
+JAR = 1
+CRITICAL_ASSET = 2
+ASSET = 3
+
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+MAX_LIMIT = client.CONNECTION_LIMIT_PER_HOST
+# multiplicative decrease on congestion/rate limits
+DECREASE_FACTOR = 0.5
+# at most one decrease per window, the transfers in flight still see the old limit
+DECREASE_COOLDOWN = 1.0
+# a time to first byte this many times above the best one seen is treated as congestion
+LATENCY_FACTOR = 4
+# host throughput is compared between windows of this length
+THROUGHPUT_WINDOW = 2.0
+# used if a 429/503 has no Retry-After header
+DEFAULT_RETRY_AFTER = 5.0
+STATS_INTERVAL = 5.0
+
+
+class RateLimitedError(Exception):
+    def __init__(self, url:str, retry_after:float):
+        super().__init__(f"Rate limited: {url}, retry after {retry_after:.0f}s")
+        self.url = url
+        self.retry_after = retry_after
+
+
+def _header_float(headers, name:str) -> float|None:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class HostLimiter():
+    '''
+    Concurrency limit for one host with a priority queue and AIMD adaption
+
+    The limit grows by 1/limit per successful transfer and is halved when the
+    host answers 429/503, the latency spikes or the throughput drops after an increase.
+    '''
+
+    def __init__(self, host:str):
+        self.host = host
+        self.limit = float(INITIAL_LIMIT)
+        self.active = 0
+        self.waiters = []
+        self.paused_until = 0.0
+        self.best_latency = None
+        self.last_decrease = 0.0
+        self._seq = itertools.count()
+        self._timer = None
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._last_rate = None
+        self._last_rate_limit = self.limit
+
+    def _has_capacity(self) -> bool:
+        return self.active < int(self.limit) and time.monotonic() >= self.paused_until
+
+    async def acquire(self, key:tuple):
+        if not self.waiters and self._has_capacity():
+            self.active += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (key, next(self._seq), fut))
+        self._wake()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # got the slot but was cancelled before using it
+                self.release()
+            raise
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            if self._timer is None:
+                def resume():
+                    self._timer = None
+                    self._wake()
+                self._timer = asyncio.get_running_loop().call_later(self.paused_until - now, resume)
+            return
+        while self.waiters and self.active < int(self.limit):
+            _, _, fut = heapq.heappop(self.waiters)
+            if fut.done():
+                continue
+            self.active += 1
+            fut.set_result(None)
+
+    def _decrease(self, reason:str):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return
+        self.last_decrease = now
+        self.limit = max(MIN_LIMIT, self.limit * DECREASE_FACTOR)
+        logger.debug(f"{self.host}: {reason}, limit -> {self.limit:.1f}")
+
+    def pause(self, seconds:float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def on_response(self, status:int, latency:float, headers):
+        '''
+        Adapts the limit to a response (called once the headers arrived)
+        '''
+        if status in (429, 503):
+            self._decrease(f"status {status}")
+            self.pause(_header_float(headers, "Retry-After") or DEFAULT_RETRY_AFTER)
+            return
+        remaining = _header_float(headers, "X-RateLimit-Remaining")
+        if remaining is not None and remaining <= self.active:
+            # about to run into the rate limit, wait for the window to reset
+            self.limit = max(MIN_LIMIT, min(self.limit, remaining or MIN_LIMIT))
+            if remaining <= 0:
+                self.pause(_header_float(headers, "X-RateLimit-Reset") or DEFAULT_RETRY_AFTER)
+            return
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if latency > LATENCY_FACTOR * self.best_latency and latency > 0.2:
+            self._decrease(f"latency {latency:.2f}s")
+        else:
+            self.limit = min(MAX_LIMIT, self.limit + 1 / self.limit)
+
+    def on_complete(self, size:int):
+        '''
+        Tracks the host throughput, undoes increases that made it worse
+        '''
+        self._window_bytes += size
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < THROUGHPUT_WINDOW:
+            return
+        rate = self._window_bytes / elapsed
+        if self._last_rate and rate < self._last_rate * 0.7 and self.limit > self._last_rate_limit:
+            self._decrease("throughput dropped")
+        self._last_rate = rate
+        self._last_rate_limit = self.limit
+        self._window_start = now
+        self._window_bytes = 0
+        self._wake()
+
+
+class Slot():
+    '''
+    One transfer, use as `async with scheduler.slot(url) as slot:`
+    '''
+
+    def __init__(self, scheduler, url:str, priority:int, size:int|None):
+        self.scheduler = scheduler
+        self.url = url
+        self.host = scheduler.get_host(url)
+        self.priority = priority
+        self.size = size or 0
+        self.done = 0
+        self.started = None
+
+    async def __aenter__(self):
+        s = self.scheduler
+        s.queued += 1
+        s.bytes_expected += self.size
+        s.start_reporter()
+        try:
+            # largest first inside a priority class, keeps the tail short
+            with tracing.span("wait for slot", "scheduler", host=self.host.host, priority=self.priority):
+                await self.host.acquire((self.priority, -self.size))
+        except BaseException:
+            s.bytes_expected -= self.size
+            raise
+        finally:
+            s.queued -= 1
+        s.active += 1
+        self.started = time.monotonic()
+        return self
+
+    def response(self, response):
+        '''
+        Reports the response headers, raises RateLimitedError on 429/503
+        '''
+        self.host.on_response(response.status, time.monotonic() - self.started, response.headers)
+        if response.status in (429, 503):
+            raise RateLimitedError(self.url, max(self.host.paused_until - time.monotonic(), 0))
+
+    def progress(self, size:int):
+        self.done += size
+        self.scheduler.bytes_done += size
+
+    async def __aexit__(self, exc_type, exc, tb):
+        s = self.scheduler
+        s.active -= 1
+        s.bytes_expected -= self.size
+        s.bytes_done -= self.done
+        s.bytes_finished += self.done
+        if exc_type is None:
+            s.transfers += 1
+        self.host.on_complete(self.done)
+        self.host.release()
+
+
+class Scheduler():
+    '''
+    Owns every transfer of a launch: per host limits, priorities and live stats
+    '''
+
+    def __init__(self):
+        self.hosts = {}
+        self.queued = 0
+        self.active = 0
+        self.transfers = 0
+        # sizes of queued/active transfers and bytes received by the active ones
+        self.bytes_expected = 0
+        self.bytes_done = 0
+        self.bytes_finished = 0
+        self.started = time.monotonic()
+        self._reporter = None
+
+    def get_host(self, url:str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostLimiter(host)
+        return self.hosts[host]
+
+    def slot(self, url:str, priority:int=ASSET, size:int|None=None) -> Slot:
+        '''
+        Args:
+            url: request url, the host decides the limiter
+            priority: priority class (META, JAR, CRITICAL_ASSET, ASSET)
+            size: expected size in bytes if known, used for ordering and the ETA
+        '''
+        return Slot(self, url, priority, size)
+
+    def stats(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        received = self.bytes_finished + self.bytes_done
+        rate = received / elapsed
+        remaining = max(self.bytes_expected - self.bytes_done, 0)
+        return {
+            "queued": self.queued,
+            "active": self.active,
+            "transfers": self.transfers,
+            "bytes": received,
+            "throughput": rate,
+            "eta": remaining / rate if rate else None,
+            "limits": {host: round(limiter.limit, 1) for host, limiter in self.hosts.items()},
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        eta = f"{stats['eta']:.0f}s" if stats["eta"] is not None else "?"
+        logger.info(
+            f"{stats['throughput'] / 1e6:.1f} MB/s, {stats['active']} active, "
+            f"{stats['queued']} queued, ETA {eta}"
+        )
+
+    def start_reporter(self):
+        if self._reporter is None or self._reporter.done():
+            self._reporter = asyncio.ensure_future(self._report())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            if not self.queued and not self.active:
+                break
+            self.log_stats()
+
+
+_scheduler = None
+_scheduler_loop = None
+
+
+def get_scheduler() -> Scheduler:
+    '''
+    Returns the launch-scoped scheduler
+    '''
+    global _scheduler, _scheduler_loop
+    loop = asyncio.get_running_loop()
+    if _scheduler is None or _scheduler_loop is not loop:
+        _scheduler = Scheduler()
+        _scheduler_loop = loop
+    return _scheduler
@@ -1,90 +1,324 @@
 import asyncio
-import hashlib
+import json
 import logging
 import os
 from pathlib import Path
 import zipfile
 import networking.api as api
+import utils.hashing as hashing
+import utils.store as store
+import utils.staging as staging
+import utils.tracing as tracing
 import config
 import shutil
+import time
 
 logger = logging.getLogger("Assets")
 
 IGNORE_LIST = []
 
 ASSET_PATH = "NoRiskClient/assets"
+HASH_CACHE_PATH = "NoRiskClient/.nrc-hash-cache.json"
+HASH_CACHE_VERSION = 1
+MANIFEST_PATH = "NoRiskClient/.nrc-asset-manifest.json"
+MANIFEST_VERSION = 1
+# unchanged assets are trusted for this long, then every asset is verified again
+# (catches files that were deleted or edited outside of the wrapper)
+FULL_VERIFY_INTERVAL = 7 * 24 * 60 * 60
 
+# path -> [size, mtime_ns, inode, md5] of the last verified state of each asset
+hash_cache = {}
 
-try:
-    os.makedirs(ASSET_PATH,exist_ok=True)
-finally:
-    pass
+WATERMARK_ASSET = "nrc-cosmetics/assets/noriskclient/textures/noriskclient-logo-text.png"
 
 if config.REMOVE_WATERMARK:
-    IGNORE_LIST.append("nrc-cosmetics/assets/noriskclient/textures/noriskclient-logo-text.png")
+    IGNORE_LIST.append(WATERMARK_ASSET)
 
-concurrent_downloads = 20
-async def verify_asset(path,data):
+def read_hash_cache() -> dict:
+    '''
+    Reads the persistent asset hash cache
 
-    file_path = Path(f"{ASSET_PATH}/{path}")
-    if file_path.is_file():
-        local_hash = await calc_hash(file_path)
-        if not local_hash == data.get("hash"):
-            return path, data
-    else:
-        return path, data
+    Returns:
+        cache:dict | path -> [size, mtime_ns, inode, hash]
+    '''
+    try:
+        with open(HASH_CACHE_PATH) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if data.get("version") != HASH_CACHE_VERSION:
+        return {}
+    return data.get("entries", {})
+
+def write_hash_cache(cache:dict):
+    '''
+    Atomically writes the asset hash cache to disk
+    '''
+    dest = staging.stage(HASH_CACHE_PATH)
+    tmp = f"{dest}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": HASH_CACHE_VERSION, "entries": cache}, f, separators=(",", ":"))
+    os.replace(tmp, dest)
 
+def read_manifest() -> dict|None:
+    '''
+    Reads the last applied asset manifest
+
+    Returns:
+        manifest:dict | {"verified": time of the last full verification, "objects": path -> md5}
+        or None if there is no usable manifest
+    '''
+    try:
+        with open(MANIFEST_PATH) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if data.get("version") != MANIFEST_VERSION:
+        return None
+    return data
 
-async def calc_hash(file:Path):
+def write_manifest(objects:dict, verified:float):
     '''
-    Calculates the md5 hash for given path
-    
+    Atomically writes the applied asset manifest
+
     Args:
-        file: path to a file
+        objects: path -> md5 of every installed and verified asset
+        verified: time of the last full verification
     '''
-    with open(file,'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+    dest = staging.stage(MANIFEST_PATH)
+    tmp = f"{dest}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "verified": verified, "objects": objects}, f, separators=(",", ":"))
+    os.replace(tmp, dest)
 
-async def main(nrc_token:str):
+def diff_manifest(applied:dict, objects:dict):
     '''
-    Verifys and Downloads Assets
+    Compares the applied manifest with the current asset metadata
+
+    Args:
+        applied: path -> md5 of the installed assets
+        objects: path -> (md5, size) of the pack
+
+    Returns:
+        changed:list | paths that were added or whose hash changed
+        removed:list | paths that are no longer part of the pack
+    '''
+    changed = [
+        path for path, (hash, _) in objects.items()
+        if applied.get(path) != hash
+    ]
+    removed = [path for path in applied if path not in objects]
+    return changed, removed
+
+def stat_key(st:os.stat_result) -> list:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def remember_hash(path:str, hash:str):
+    '''
+    Stores the hash of an asset together with its current stat data
+
+    Args:
+        path: asset path relative to ASSET_PATH
+        hash: verified md5 hash of the file
+    '''
+    try:
+        st = os.stat(staging.stage(f"{ASSET_PATH}/{path}"))
+    except FileNotFoundError:
+        hash_cache.pop(path, None)
+        return
+    hash_cache[path] = stat_key(st) + [hash]
+
+async def verify_asset(path,asset:tuple):
+
+    file_path = Path(f"{ASSET_PATH}/{path}")
+    try:
+        st = file_path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        hash_cache.pop(path, None)
+        return path, asset
+
+    cached = hash_cache.get(path)
+    if cached and cached[:3] == stat_key(st):
+        # metadata unchanged since the last verification, no need to read the file
+        local_hash = cached[3]
+    else:
+        local_hash = await hashing.calc_hash(file_path)
+        hash_cache[path] = stat_key(st) + [local_hash]
+
+    if not local_hash == asset[0]:
+        return path, asset
+
+
+async def install_asset(hash:str, assets:list, nrc_token:str):
+    '''
+    Installs all assets sharing the same content, the object is downloaded into
+    the shared store at most once and then linked to every path
 
     Args:
+        hash: md5 hash of the content
+        assets: list of (path, asset_info) with that hash
         nrc_token: a valid noriskclient token
     '''
+    with tracing.span("install asset", "assets", path=assets[0][0], copies=len(assets)) as span:
+        if not config.USE_SHARED_STORE:
+            span.set(store="off")
+            for path, asset_data in assets:
+                await api.download_single_asset("norisk-prod",path,asset_data,nrc_token,dest=staging.stage(f"{ASSET_PATH}/{path}"))
+            return
+        if not store.has(hash):
+            span.set(store="miss")
+            path, asset_data = assets[0]
+            await api.download_single_asset("norisk-prod",path,asset_data,nrc_token,dest=store.object_path(hash))
+        else:
+            span.set(store="hit")
+            logger.debug(f"Using stored object for {assets[0][0]}")
+        for path, _ in assets:
+            store.link(hash, staging.stage(f"{ASSET_PATH}/{path}"))
+
+async def plan() -> dict:
+    '''
+    Fetches the asset metadata and verifies the local assets, needs no token and changes nothing
+
+    Returns:
+        plan:dict | objects: path -> md5 of every asset of the pack except the ignored ones
+        fetch: {path, hash, size, cached} of missing or changed assets, cached if the shared store has them
+        remove: paths that are no longer part of the pack
+        verified: time of the last full verification, None if this one verified everything
+    '''
     logger.info("Verifying Assets")
-    metadata = await api.get_asset_metadata("norisk-prod")
-    logger.info("Verifying Assets")
+    objects = await api.get_asset_metadata("norisk-prod")
+    # ignored assets are never written to the applied manifest, they would count as changed on every launch
+    objects = {path: info for path, info in objects.items() if path not in IGNORE_LIST}
+    # the prefetcher verifies several instances in one process
+    hash_cache.clear()
+    hash_cache.update(read_hash_cache())
+    if objects:
+        for stale in hash_cache.keys() - objects.keys():
+            del hash_cache[stale]
+
+    manifest = read_manifest()
+    if objects and manifest and time.time() - manifest.get("verified", 0) < FULL_VERIFY_INTERVAL:
+        # only what changed since the last applied manifest has to be looked at
+        verified = manifest.get("verified")
+        names, removed = diff_manifest(manifest.get("objects", {}), objects)
+        removed = [name for name in removed if name not in IGNORE_LIST]
+        if names:
+            logger.info(f"{len(names)} assets changed since the last launch")
+    else:
+        verified = None
+        names, removed = objects.keys(), []
+
     verify_tasks = []
-    for name, asset_info in metadata.get("objects", {}).items():
-        if name not in IGNORE_LIST:
-            task = verify_asset(
-                name,
-                asset_info
-            )
-            verify_tasks.append(task)
-    results = await asyncio.gather(*verify_tasks)
-    downloads = [result for result in results if result is not None]
-
-    semaphore = asyncio.Semaphore(concurrent_downloads)
+    for name in names:
+        task = verify_asset(
+            name,
+            objects[name]
+        )
+        verify_tasks.append(task)
+    with tracing.span("verify assets", "assets", objects=len(verify_tasks), full=verified is None) as span:
+        results = await asyncio.gather(*verify_tasks)
+        downloads = [result for result in results if result is not None]
+        span.set(outdated=len(downloads))
+    return {
+        "verified": verified,
+        "objects": {path: hash for path, (hash, _) in objects.items()},
+        "fetch": [
+            {"path": path, "hash": hash, "size": size, "cached": store.has(hash)}
+            for path, (hash, size) in downloads
+        ],
+        "remove": removed,
+    }
+
+async def execute(nrc_token:str, asset_plan:dict):
+    '''
+    Carries out an asset plan
+
+    Args:
+        nrc_token: a valid noriskclient token
+        asset_plan: plan made by plan()
+
+    Returns:
+        True if every asset is installed and verified
+    '''
+    objects = asset_plan["objects"]
+    os.makedirs(ASSET_PATH,exist_ok=True)
+    for name in asset_plan["remove"]:
+        staging.remove(f"{ASSET_PATH}/{name}")
+    if asset_plan["remove"]:
+        logger.info(f"Removed {len(asset_plan['remove'])} assets that are no longer part of the pack")
+
+    by_hash = {}
+    for asset in asset_plan["fetch"]:
+        by_hash.setdefault(asset["hash"], []).append((asset["path"], asset))
+
+    # concurrency is limited per host by the download scheduler
     tasks = []
-    for path, asset_data in downloads:
-        task = api.download_single_asset("norisk-prod",path,asset_data,nrc_token,semaphore)
+    for hash, assets in by_hash.items():
+        task = install_asset(hash,assets,nrc_token)
         tasks.append(task)
-    logger.info("Downloading missing")
+    if tasks:
+        logger.info(f"Downloading {len(asset_plan['fetch'])} missing assets")
     results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = set()
+    for (hash, assets), result in zip(by_hash.items(), results):
+        if not isinstance(result, BaseException):
+            for path, _ in assets:
+                remember_hash(path, hash)
+        else:
+            failed.update(path for path, _ in assets)
+    write_hash_cache(hash_cache)
+    if objects:
+        # failed assets are left out so the next launch picks them up again
+        applied = {
+            path: hash for path, hash in objects.items()
+            if path not in failed and path not in IGNORE_LIST
+        }
+        write_manifest(applied, asset_plan["verified"] or time.time())
+    if failed:
+        logger.warning(f"Failed to install {len(failed)} assets")
+
+    if config.REMOVE_WATERMARK and not staging.enabled:
+        remove_watermark()
 
-    if config.REMOVE_WATERMARK:
+    return bool(objects) and not failed
+
+def remove_watermark():
+    '''
+    Replaces the watermark texture with the one shipped with the wrapper
+
+    The texture may be a hardlink into the shared store(if it was installed
+    before remove_watermark was turned on), so it is never written in place
+    but replaced by a new file.
+    '''
+    dest = f"{ASSET_PATH}/{WATERMARK_ASSET}"
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
         try:
             #dev env
-            shutil.copy(f"{config.WRAPPER_ROOT}/assets/no_watermark.png", f"{ASSET_PATH}/nrc-cosmetics/assets/noriskclient/textures/noriskclient-logo-text.png")
+            shutil.copyfile(f"{config.WRAPPER_ROOT}/assets/no_watermark.png", tmp)
         except (NotADirectoryError,FileNotFoundError):
             # in pyz package
             with zipfile.ZipFile(config.WRAPPER_ROOT, 'r') as z:
                 with z.open("assets/no_watermark.png") as src_file:
-                    with open(f"{ASSET_PATH}/nrc-cosmetics/assets/noriskclient/textures/noriskclient-logo-text.png", 'wb') as dst_file:
+                    with open(tmp, 'wb') as dst_file:
                         shutil.copyfileobj(src_file, dst_file)
+        os.replace(tmp, dest)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
 
+async def main(nrc_token:str):
+    '''
+    Verifys and Downloads Assets
 
+    Args:
+        nrc_token: a valid noriskclient token
 
-
+    Returns:
+        True if every asset is installed and verified
+    '''
+    return await execute(nrc_token, await plan())
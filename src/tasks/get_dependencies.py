@@ -1,36 +1,38 @@
-import importlib
+import importlib.util
 import subprocess
 import sys
 import logging
 logger = logging.getLogger("Dependency Checker")
 
 
-REQUIRED_PACKAGES = [
-    'PyJWT',
-    'httpx',
-    'uuid',
-    'aiofiles',
-    'packaging',
-    'json5',
-    'aiohttp',
-    'requests',
-    'tenacity',
-    'duckdb'
-    ]
+# pip package -> top level module
+REQUIRED_PACKAGES = {
+    'PyJWT': 'jwt',
+    'uuid': 'uuid',
+    'aiofiles': 'aiofiles',
+    'packaging': 'packaging',
+    'json5': 'json5',
+    'aiohttp': 'aiohttp',
+    'tenacity': 'tenacity',
+    'duckdb': 'duckdb',
+    }
 
 
 def install_package(package):
     """Install a package using pip."""
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 def check_dependencies():
-    """Check if all required packages are installed."""
+    """
+    Check if all required packages are installed.
+
+    Only looks the modules up on sys.path without importing them, so packages
+    that are not needed for this launch (duckdb for prism for example) cost nothing.
+    """
     missing_packages = []
-    for package in REQUIRED_PACKAGES:
-        try:
-            importlib.import_module(package.split('>')[0].split('<')[0].split('=')[0].replace("PyJWT", "jwt"))
-        except ImportError:
+    for package, module in REQUIRED_PACKAGES.items():
+        if importlib.util.find_spec(module) is None:
             missing_packages.append(package)
-    
+
     if missing_packages:
         logger.info(f"Installing missing dependencies: {', '.join(missing_packages)}")
         for package in missing_packages:
@@ -39,5 +41,4 @@ def check_dependencies():
             except subprocess.CalledProcessError as e:
                 logger.error(f"Failed to install {package}: {e}")
                 sys.exit(1)
-
-check_dependencies()
+        importlib.invalidate_caches()
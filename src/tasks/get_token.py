@@ -1,15 +1,45 @@
-from pathlib import Path
+import asyncio
 import time
 import logging
-import jwt
+import os
 import networking.api as api
 import json
-import duckdb
 import config
+import utils.file_lock as file_lock
+import utils.launcher_context as launcher_context
+import utils.tracing as tracing
 path = config.PRISM_DATA_DIR
 logger = logging.getLogger("Norisk Token")
 
+# a stored token expiring within this many seconds is still used but refreshed in the background
+REFRESH_WINDOW = 24 * 60 * 60
+# how long a launch waits for another process that is refreshing the token
+TOKEN_LOCK_TIMEOUT = 30
 
+# set when the stored token was used but should be refreshed, see refresh()
+refresh_due = False
+
+
+
+def token_expires_in(token) -> float:
+    '''
+    Returns the seconds until the token expires, negative if it already did
+    (or if it can't be decoded)
+
+    Args:
+        token: a noriskclient token
+    '''
+    import jwt
+
+    try:
+        decoded = jwt.decode(
+            token.encode('utf-8'),
+            options={"verify_signature": False},
+            algorithms=["HS256", "none"]
+        )
+        return decoded.get('exp') - time.time()
+    except (jwt.InvalidTokenError, TypeError):
+        return -1
 
 async def is_token_expired(token):
     '''
@@ -21,21 +51,29 @@ async def is_token_expired(token):
     returns:
         True|False
     '''
-    token_byte = token.encode('utf-8')
-    decoded = jwt.decode(
-             token_byte,
-            options={"verify_signature": False},
-            algorithms=["HS256", "none"]
-        )
-    exp_time = decoded.get('exp')
-    current_time = time.time()
-    if current_time > exp_time:
+    if token_expires_in(token) <= 0:
         logger.warning("Stored Token is expired")
         return True
     else:
         logger.info("Stored Token is valid")
         return False
 
+def read_tokens(path) -> dict:
+    '''
+    Reads all stored tokens
+
+    Args:
+        path: path to the dir that contains norisk_data.json
+
+    Returns:
+        tokens:dict | profile id -> token
+    '''
+    try:
+        with open(f"{path}/norisk_data.json", "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
 async def read_token_from_file(path,uuid):
     '''
     Reads the token from disk
@@ -46,54 +84,117 @@ async def read_token_from_file(path,uuid):
     Returns:
         Stored token for given profile id: str
     '''
-    if Path(f"{path}norisk_data.json").is_file():
-        with open(f"{path}norisk_data.json", "r") as f:
-            data = json.load(f)
-            if uuid in data:
-                return data[uuid]
-async def get_modrinth_data():
-    data = duckdb.connect(config.MODRINTH_DATA_PATH,read_only=True)
-
-    data = data.sql("SELECT access_token,username,uuid FROM minecraft_users where active = 1").fetchall()
-    return data[0]
+    return read_tokens(path).get(uuid)
+async def write_token(token:str,player_uuid,path):
+    '''
+    Writes given token to norisk_data.json file
 
+    The file is shared by all instances, callers hold the token lock so no
+    update is lost and it is replaced atomically so readers never see half a file.
 
-async def get_prsim_data(path):
+    Args:
+        token: norisk token to write 
+        player_uuid: profile id
+        path: path to the dir that contains norisk_data.json
     '''
-    Reads Account data from accounts.json
+    data = read_tokens(path)
+    data[str(player_uuid)] = token
+    tmp = f"{path}/norisk_data.json.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(json.dumps(data,indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, f"{path}/norisk_data.json")
 
-    Args:
-        path: path to the dir that contains accounts.json
 
-    returns:
+async def get_account_data():
+    '''
+    Reads the active account from the detected launcher
+
+    Returns:
         Microsoft Account Token:str
         Minecraft IGN:str
         Profile ID:str/uuid
     '''
-    with open(f"{path}/accounts.json","r") as f:
-        accounts = json.load(f)
-    active = next((item for item in accounts.get("accounts") if item.get('active')), None)
-    return active.get("ygg").get("token") , active.get("profile").get("name") , active.get("profile").get("id")
-    
-async def write_token(token:str,player_uuid,path):
-    '''
-    Writes given token to norisk_data.json file
+    context = await launcher_context.get()
+    return context.access_token, context.username, context.uuid
 
-    Args:
-        token: norisk token to write 
-        player_uuid: profile id
-        path: path to the dir that contains norisk_data.json
+
+def _check_stored(stored_token) -> bool:
     '''
-    if Path(f"{path}/norisk_data.json").is_file():
-        with open(f"{path}/norisk_data.json", "r") as f:
-            data = json.load(f)
+    True if the stored token can be used for this launch, flags it for a
+    refresh if it expires soon
+    '''
+    global refresh_due
+    if not stored_token:
+        return False
+    remaining = token_expires_in(stored_token)
+    if remaining <= 0:
+        logger.warning("Stored Token is expired")
+        return False
+    if remaining < REFRESH_WINDOW:
+        logger.info(f"Stored Token expires in {remaining / 3600:.1f}h, refreshing it in the background")
+        refresh_due = True
     else:
-        data = {}
-    data[str(player_uuid)] = token
-    with open(f"{path}/norisk_data.json", "w") as f:
-        f.write(json.dumps(data,indent=2))
+        logger.info("Stored Token is valid")
+    return True
 
+async def get_stored_token():
+    '''
+    Gets a still valid token from disk without any network requests
+
+    Returns:
+        norisk_token:str|None
+    '''
+    _, _, uuid = await get_account_data()
+    stored_token = await read_token_from_file(path,uuid)
+    if _check_stored(stored_token):
+        return stored_token
+    return None
+
+async def authenticate(mc_token, mc_name, uuid, server_id=None) -> str:
+    '''
+    Gets a new token from the norisk api and stores it
+
+    Waits for the token lock first, if another instance refreshed the token
+    meanwhile that one is used instead.
+
+    Optional:
+        server_id=None| a server id that was already requested
 
+    Returns:
+        norisk_token:str
+    '''
+    with tracing.span("authenticate", "token") as span:
+        lock = await file_lock.lock(f"{path}/norisk_data.json.lock", TOKEN_LOCK_TIMEOUT)
+        try:
+            stored_token = read_tokens(path).get(uuid)
+            if stored_token and token_expires_in(stored_token) >= REFRESH_WINDOW:
+                logger.info("Token was refreshed by another instance")
+                span.set(source="other instance")
+                return stored_token
+            norisk_server_id = await (server_id or api.request_server_id())
+            await api.join_server_session(mc_token,uuid,norisk_server_id)
+            norisk_token = await api.validate_with_norisk_api(mc_name,norisk_server_id)
+            await write_token(norisk_token,uuid,path)
+            span.set(source="norisk api")
+            return norisk_token
+        finally:
+            if isinstance(server_id, asyncio.Future) and not server_id.done():
+                server_id.cancel()
+            file_lock.unlock(lock)
+
+async def refresh():
+    '''
+    Refreshes the stored token of the active account if it expires soon,
+    runs detached from the launch
+    '''
+    mc_token, mc_name, uuid = await get_account_data()
+    stored_token = await read_token_from_file(path,uuid)
+    if stored_token and token_expires_in(stored_token) >= REFRESH_WINDOW:
+        return
+    await authenticate(mc_token, mc_name, uuid)
+    logger.info("Refreshed Norisk token")
 
 async def main():
     '''
@@ -102,17 +203,20 @@ async def main():
     Returns:
         norisk_token:str
     '''
-    if config.LAUNCHER == "modrinth":
-        mc_token, mc_name, uuid = await get_modrinth_data()
-    else:
-        mc_token, mc_name, uuid = await get_prsim_data(path)
-
-    stored_token = await read_token_from_file(path,uuid)
-    if stored_token:
-        if not await is_token_expired(stored_token):
-            return stored_token
-    norisk_server_id = await api.request_server_id()
-    await api.join_server_session(mc_token,uuid,norisk_server_id)
-    norisk_token = await api.validate_with_norisk_api(mc_name,norisk_server_id)
-    await write_token(norisk_token,uuid,path)
-    return norisk_token
+    tokens = read_tokens(path)
+    server_id = None
+    if not any(token_expires_in(token) > 0 for token in tokens.values()):
+        # no usable token for any account, the server id is needed anyway so
+        # it is requested while the account is read
+        server_id = asyncio.ensure_future(api.request_server_id())
+    try:
+        with tracing.span("read account", "token"):
+            mc_token, mc_name, uuid = await get_account_data()
+    except BaseException:
+        if server_id is not None:
+            server_id.cancel()
+        raise
+    if _check_stored(tokens.get(uuid)):
+        tracing.instant("stored token valid", "token")
+        return tokens[uuid]
+    return await authenticate(mc_token, mc_name, uuid, server_id)
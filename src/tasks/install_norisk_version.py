@@ -1,21 +1,29 @@
 import asyncio
 from dataclasses import dataclass
-import hashlib
 import json
 import logging
 import os
 
-import duckdb
 import config
-from pathlib import Path
 from urllib.parse import urljoin
 import networking.api as api
+import utils.hashing as hashing
+import utils.store as store
+import utils.staging as staging
+import utils.tracing as tracing
+import utils.launcher_context as launcher_context
 import networking.modrinth_api as modrinth
 
 logger = logging.getLogger("Jars Geatherer")
 
+INDEX_PATH = ".nrc-index.json"
+INDEX_VERSION = 2
+# digests of the jars in ./mods that are not in the index(user added or left over)
+JAR_CACHE_PATH = ".nrc-jar-cache.json"
+JAR_CACHE_VERSION = 1
 
-@dataclass
+
+@dataclass(slots=True)
 class ModEntry():
     hash_md4 : str
     version : str
@@ -27,16 +35,8 @@ class ModEntry():
     groupId : str
     modrinth_id : str
     maven_id :str
-
-async def calc_hash(file:Path):
-    '''
-    Calculates the md5 hash for given path
-    
-    Args:
-        file: path to a file
-    '''
-    with open(file,'rb') as f:
-        return hashlib.md5(f.read()).hexdigest()
+    # published by the source (modrinth file hashes or the maven .sha1 sidecar)
+    sha1 : str|None = None
 
 async def get_mc_version():
     '''
@@ -45,91 +45,264 @@ async def get_mc_version():
     Returns:
         minecraft_version:str
     '''
-    if config.LAUNCHER == "prism":
-        with open("../mmc-pack.json") as f:
-            mmc_pack = json.load(f)
-            for component in mmc_pack.get("components"):
-                if component.get("uid") == "net.minecraft":
-                    return component.get("version")
-    else:
-        try:
-            data = duckdb.connect(config.MODRINTH_DATA_PATH,read_only=True)
-            current_dir_name = Path(os.getcwd()).name
-            data = data.sql(f"SELECT game_version FROM profiles WHERE path = '{current_dir_name}'").fetchall()
-            return data[0][0]
-        except Exception as e:
-            raise Exception(e)
-    
+    mc_version = (await launcher_context.get()).mc_version
+    if mc_version is None:
+        raise Exception("Could not detect the Minecraft version of this instance")
+    return mc_version
+
 
-async def download_jar(url,filename,version:str,ID:str, old_file=None):
+async def download_jar(transaction:staging.Transaction,url,filename,version:str,ID:str, old_file=None, size=None, sha1=None):
     '''
-    Downloads a jar file from given url
+    Downloads a jar file from given url, it is installed when transaction is committed
 
     Args:
+        transaction: the install the jar is part of
         url:str | download url
         filename:str | name of the downloaded file
         version:str | version that will be installed
         ID:str | mod ID
 
     Optional:
-        old_file=None| old file to delete
+        old_file=None| old file to delete on commit
+        size=None| expected size if known, helps the download scheduler
+        sha1=None| upstream sha1, the download has to match it and the shared store is keyed by it
     
     Returns:
         index_entry:dict | a dict in the format of the index
     '''
 
-    a = await api.download_jar(url,filename)
-    if a != old_file and a is not None and old_file is not None:
-        os.remove(f"./mods/{old_file}")
+    dest = transaction.stage(f"./mods/{filename}")
+    with tracing.span("install jar", "mods", file=filename) as span:
+        if sha1:
+            # the index keeps md5 so the installed jars are checked the same way as before
+            if store.link(sha1, dest, "sha1"):
+                span.set(store="hit")
+                logger.info(f"Installed {filename} from the shared store")
+                digest = store.lookup_md5(sha1)
+                if digest is None:
+                    # stored before the md5 was kept next to the objects
+                    digest = await hashing.calc_hash(dest)
+                    store.remember_md5(sha1, digest)
+            else:
+                span.set(store="miss")
+                # fetched into the store first, instances syncing at the same time wait for it instead of fetching it too
+                target = store.object_path(sha1, "sha1") if config.USE_SHARED_STORE else dest
+                digests = await api.download_jar(url,filename,target,size,sha1,("sha1","md5"))
+                digest = digests["md5"]
+                if target != dest:
+                    store.remember_md5(sha1, digest)
+                    store.link(sha1, dest, "sha1")
+        else:
+            digest = store.lookup_url(url)
+            if store.link(digest, dest):
+                span.set(store="hit")
+                logger.info(f"Installed {filename} from the shared store")
+            else:
+                span.set(store="miss")
+                digest = await api.download_jar(url,filename,dest,size)
+                store.add(dest, digest)
+                store.remember_url(url, digest)
+    # the move keeps size and mtime, the entry stays valid after the commit
+    st = os.stat(dest)
+    if old_file is not None and old_file != filename:
+        transaction.remove(f"./mods/{old_file}")
     # stuffs thats written to index
     return {
         "id": ID,
-        "hash": await calc_hash(f"./mods/{filename}"),
+        "filename": filename,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": digest,
+        "sha1": sha1,
         "version": version
     }
 
 
+async def adopt_jar(transaction:staging.Transaction, jar:dict):
+    '''
+    Takes over a jar that is already in ./mods and matches the upstream sha1
+
+    Args:
+        transaction: the install the jar is part of
+        jar: "adopt" entry of a jar plan
+
+    Returns:
+        index_entry:dict | a dict in the format of the index
+    '''
+    filename = jar["filename"]
+    logger.info(f"{filename} matches {jar['id']} {jar['version']}, no download needed")
+    path = f"./mods/{filename}"
+    digest = jar.get("hash") or await hashing.calc_hash(path)
+    st = os.stat(path)
+    if jar.get("old_file") is not None and jar["old_file"] != filename:
+        transaction.remove(f"./mods/{jar['old_file']}")
+    return {
+        "id": jar["id"],
+        "filename": filename,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "hash": digest,
+        "sha1": jar.get("sha1"),
+        "version": jar["version"]
+    }
+
+
 async def read_index():
     '''
-    Reads installed versions index
+    Reads installed versions index, the old list format is converted on the fly
 
     Returns:
-        index_data:list
+        index_data:dict | mod id -> {filename, size, mtime_ns, hash, version}
     '''
     try:
-        with open(".nrc-index.json") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return []
+        with open(INDEX_PATH) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if isinstance(data, list):
+        # v1: [{id, hash, version}], filenames are found by hash once and the index is rewritten
+        logger.info("Migrating mod index to the new format")
+        return {entry.get("id"): {"hash": entry.get("hash"), "version": entry.get("version")} for entry in data}
+    if data.get("version") != INDEX_VERSION:
+        return {}
+    return data.get("mods", {})
+
+def find_indexed_file(entry:dict):
+    '''
+    Looks up the jar of an index entry, the user may have (un)disabled it since
+
+    Returns:
+        (filename, stat_result) or (None, None)
+    '''
+    filename = entry.get("filename")
+    if not filename:
+        return None, None
+    base = filename.removesuffix(".disabled")
+    for name in (filename, base, f"{base}.disabled"):
+        try:
+            return name, os.stat(f"./mods/{name}")
+        except FileNotFoundError:
+            continue
+    return None, None
 
 async def get_installed_versions():
     '''
-    Scans the mod dir for installed mods and links them to thier index entry
+    Links the installed mods to thier index entry
+
+    Jars are only hashed if their size/mtime changed since they were indexed,
+    a full scan of the mod dir only happens for entries whose file is gone
+    (or when migrating an old index).
 
     Returns
         result:dict
     '''
 
     index = await read_index()
-    hashes = {}
-    files = os.scandir("./mods")
-    for f in files:
-        if f.name.endswith(".jar") or f.name.endswith(".jar.disabled"):
-            hashes[await calc_hash(f)] = {
-                "filename" : f.name
-            }
-
     result = {}
-    for entry in index:
-        if entry.get("hash") in hashes:
-            result[entry.get("id")] = {
-                "version": entry.get("version"),
-                "filename": hashes.get(entry.get("hash")).get("filename"),
-                "hash":entry.get("hash")
-            }
+    rehash = []
+    missing = {}
+    for mod_id, entry in index.items():
+        name, st = find_indexed_file(entry)
+        if st is None:
+            missing[mod_id] = entry
+        elif st.st_size == entry.get("size") and st.st_mtime_ns == entry.get("mtime_ns"):
+            result[mod_id] = dict(entry, filename=name)
+        else:
+            rehash.append((mod_id, entry, name, st))
+
+    digests = await asyncio.gather(*(hashing.calc_hash(f"./mods/{name}") for _, _, name, _ in rehash))
+    for (mod_id, entry, name, st), digest in zip(rehash, digests):
+        if digest == entry.get("hash"):
+            result[mod_id] = dict(entry, filename=name, size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+    if missing:
+        claimed = {entry.get("filename") for entry in result.values()}
+        files = [
+            f for f in os.scandir("./mods")
+            if (f.name.endswith(".jar") or f.name.endswith(".jar.disabled")) and f.name not in claimed
+        ]
+        digests = await asyncio.gather(*(hashing.calc_hash(f) for f in files))
+        hashes = {}
+        for f, digest in zip(files, digests):
+            hashes[digest] = f
+        for mod_id, entry in missing.items():
+            f = hashes.get(entry.get("hash"))
+            if f is not None:
+                st = f.stat()
+                result[mod_id] = dict(entry, filename=f.name, size=st.st_size, mtime_ns=st.st_mtime_ns)
     return result
 
 
+def read_jar_cache() -> dict:
+    '''
+    Reads the digests of the jars that are not in the index
+
+    Returns:
+        cache:dict | filename -> [size, mtime_ns, inode, sha1, md5]
+    '''
+    try:
+        with open(JAR_CACHE_PATH) as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    if data.get("version") != JAR_CACHE_VERSION:
+        return {}
+    return data.get("entries", {})
+
+def write_jar_cache(cache:dict):
+    '''
+    Atomically writes the jar cache to disk
+    '''
+    # not staged, it only describes files that are in ./mods right now
+    tmp = f"{JAR_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"version": JAR_CACHE_VERSION, "entries": cache}, f, separators=(",", ":"))
+    os.replace(tmp, JAR_CACHE_PATH)
+
+async def get_local_catalog(installed_mods:dict, wanted:set) -> dict:
+    '''
+    Maps the sha1 of the jars in ./mods to their filename and md5
+
+    The digests of indexed jars are taken from the index. The other jars
+    are looked at only if a wanted digest is not found among them, and
+    only hashed if their size/mtime/inode changed since the last time.
+
+    Args:
+        installed_mods: index entries of the installed mods
+        wanted: sha1 digests that are looked for
+
+    Returns:
+        catalog:dict | sha1 -> (filename, md5)
+    '''
+    catalog = {
+        entry["sha1"]: (entry.get("filename"), entry.get("hash"))
+        for entry in installed_mods.values() if entry.get("sha1")
+    }
+    if not wanted or wanted <= catalog.keys():
+        return catalog
+    claimed = {entry.get("filename") for entry in installed_mods.values()}
+    cache = read_jar_cache()
+    entries = {}
+    rehash = []
+    for f in os.scandir("./mods"):
+        if not (f.name.endswith(".jar") or f.name.endswith(".jar.disabled")) or f.name in claimed:
+            continue
+        st = f.stat()
+        cached = cache.get(f.name)
+        if cached is not None and cached[:3] == [st.st_size, st.st_mtime_ns, st.st_ino]:
+            entries[f.name] = cached
+        else:
+            rehash.append((f.name, st))
+    digests = await asyncio.gather(*(hashing.calc_hash(f"./mods/{name}", ("sha1", "md5")) for name, _ in rehash))
+    for (name, st), digest in zip(rehash, digests):
+        entries[name] = [st.st_size, st.st_mtime_ns, st.st_ino, digest["sha1"], digest["md5"]]
+    if entries != cache:
+        write_jar_cache(entries)
+    for name, (_, _, _, sha1, md5) in entries.items():
+        catalog.setdefault(sha1, (name, md5))
+    return catalog
+
+
 async def get_compatible_nrc_mods(mc_version):
     '''
     Gets mods from norisk api and Filters them for  compatibility with given mc_version
@@ -143,27 +316,25 @@ async def get_compatible_nrc_mods(mc_version):
 
     '''
 
-    versions = await api.get_norisk_versions()
-    prod =versions.get("packs").get("norisk-prod")
+    pack = await api.get_norisk_versions(mc_version)
     
     mods = []
 
-    for mod in prod.get("mods"):
-        if mod.get("compatibility").get(mc_version):
-                mods.append(ModEntry(
-                    None,
-                    mod.get("compatibility").get(mc_version).get("fabric").get("identifier"),
-                    mod.get("id"),
-                    None,
-                    None,
-                    mod.get("source").get("type"),
-                    mod.get("source").get("repositoryRef"),
-                    mod.get("source").get("groupId"),
-                    mod.get("source").get("projectId"),
-                    mod.get("source").get("artifactId")
-                    ))
+    for mod_id, version, source_type, repository_ref, group_id, project_id, artifact_id in pack["mods"]:
+        mods.append(ModEntry(
+            None,
+            version,
+            mod_id,
+            None,
+            None,
+            source_type,
+            repository_ref,
+            group_id,
+            project_id,
+            artifact_id
+            ))
             
-    return mods,versions.get("repositories")
+    return mods,pack["repositories"]
 
 
 async def remove_installed_mods(mods:list[ModEntry],installed_mods:dict) -> tuple[list[ModEntry],list[ModEntry]]:
@@ -179,7 +350,7 @@ async def remove_installed_mods(mods:list[ModEntry],installed_mods:dict) -> tupl
     for mod in mods:
         if mod.ID in installed_mods:
             if mod.version != installed_mods[mod.ID].get("version"):
-                logger.info(f"Version mismatch detected installed:{installed_mods[mod.ID].get("version")} Remote Version:{mod.version}")
+                logger.info(f"Version mismatch detected installed:{installed_mods[mod.ID].get('version')} Remote Version:{mod.version}")
                 mod.old_file = installed_mods[mod.ID].get("filename")
                 result.append(mod)
             else:
@@ -189,12 +360,20 @@ async def remove_installed_mods(mods:list[ModEntry],installed_mods:dict) -> tupl
             result.append(mod)
     return result , removed
 
-async def write_to_index_file(data:list):
+async def write_to_index_file(transaction:staging.Transaction, data:list):
     '''
-    Writes data to  ".nrc-index.json" index file
+    Writes data to  ".nrc-index.json" index file, it is replaced when transaction is committed
+
+    Args:
+        transaction: the install the index belongs to
+        data: index entries with an "id" key
     '''
-    with open(".nrc-index.json","w") as f:
-        json.dump(data,f,indent=2)
+    mods = {}
+    for entry in data:
+        entry = dict(entry)
+        mods[entry.pop("id")] = entry
+    with open(transaction.stage(INDEX_PATH),"w") as f:
+        json.dump({"version": INDEX_VERSION, "mods": mods},f,indent=2)
 
 
 async def build_maven_url(artifact:ModEntry,repos):
@@ -215,15 +394,58 @@ async def build_maven_url(artifact:ModEntry,repos):
     artifact_path = f"{group_path}/{artifact.maven_id}/{artifact.version}/{filename}"
     return urljoin(repos.get(artifact.repositoryRef), artifact_path),filename
 
-async def convert_to_index(mods:list[ModEntry]):
+async def resolve_sources(mods:list[ModEntry], repos) -> list:
+    '''
+    Finds where the jars of mods come from, sets the upstream sha1 of each mod if there is one
+
+    Args:
+        mods: mods to resolve
+        repos: repository refrences
+
+    Returns:
+        sources:list | (mod, url, filename, size), mods that could not be resolved are left out
+    '''
+    sources = []
+    modrinth_mods = []
+    maven_mods = []
+
+    for mod in mods:
+        if mod.source_type == "modrinth":
+            modrinth_mods.append(mod)
+        elif mod.source_type == "maven":
+                url,filename = await build_maven_url(mod,repos)
+                maven_mods.append(mod)
+                sources.append((mod, url, filename, None))
+
+    # the maven checksums are fetched while the modrinth versions resolve
+    resolved, *checksums = await asyncio.gather(
+        modrinth.resolve_versions([(mod.ID, mod.modrinth_id, mod.ID, mod.version) for mod in modrinth_mods]),
+        *(api.get_maven_checksum(url) for _, url, _, _ in sources)
+    )
+    for mod, sha1 in zip(maven_mods, checksums):
+        mod.sha1 = sha1
+    for mod in modrinth_mods:
+        version = resolved.get(mod.ID)
+        file = modrinth.primary_file(version) if version else None
+        if file:
+            mod.sha1 = (file.get("hashes") or {}).get("sha1")
+            sources.append((mod, file.get("url"), file.get("filename"), file.get("size")))
+    return sources
+
+async def convert_to_index(mods:list[ModEntry],installed_mods:dict):
         '''
-        Converts ModEntrys to index format
+        Converts ModEntrys of installed mods to index format
         '''
         result = []
         for mod in mods:
+            installed = installed_mods[mod.ID]
             result.append({
                 "id": mod.ID,
+                "filename": installed.get("filename"),
+                "size": installed.get("size"),
+                "mtime_ns": installed.get("mtime_ns"),
                 "hash": mod.hash_md4,
+                "sha1": installed.get("sha1"),
                 "version": mod.version
             })
         return result
@@ -231,57 +453,137 @@ async def convert_to_index(mods:list[ModEntry]):
 
 
 
-async def main():
+async def plan(mc_version:str, sizes:bool=False) -> list:
     '''
-    Verifys and installs mod jars
+    Decides what has to happen to every jar, without changing anything
+
+    Args:
+        mc_version: minecraft version of the instance
+
+    Optional:
+        sizes=False| ask the server for sizes the metadata does not have(HEAD requests)
+
+    Returns:
+        jars:list | one entry per mod, "action" is keep, adopt(a matching jar is already in ./mods),
+        download or replace(download and remove old_file), "cached" if the shared store has the jar,
+        "installed" is the current index entry of an updated mod
     '''
-    mc_version = await get_mc_version()
     logger.info("getting jars")
     mods,repos = await get_compatible_nrc_mods(mc_version)
-    installed_mods = await get_installed_versions()
+    with tracing.span("scan installed mods", "mods") as span:
+        installed_mods = await get_installed_versions()
+        span.set(installed=len(installed_mods))
 
     mods, removed = await remove_installed_mods(mods,installed_mods)
+    # what is kept in the index if an update of the mod fails
+    def installed(mod):
+        if mod.ID not in installed_mods:
+            return None
+        return dict(installed_mods[mod.ID], id=mod.ID)
+
+    jars = [dict(entry, action="keep") for entry in await convert_to_index(removed,installed_mods)]
+
+    pending = await resolve_sources(mods, repos)
+    catalog = await get_local_catalog(installed_mods, {mod.sha1 for mod, _, _, _ in pending if mod.sha1})
+    for mod, url, filename, size in pending:
+        local = catalog.get(mod.sha1) if mod.sha1 else None
+        if local is not None:
+            local_file, local_hash = local
+            jars.append({
+                "action": "adopt",
+                "id": mod.ID,
+                "version": mod.version,
+                "filename": local_file,
+                "hash": local_hash,
+                "sha1": mod.sha1,
+                "old_file": mod.old_file,
+                "installed": installed(mod)
+            })
+            continue
+        cached = store.has(mod.sha1, "sha1") if mod.sha1 else store.has(store.lookup_url(url))
+        jars.append({
+            "action": "download" if mod.old_file is None else "replace",
+            "id": mod.ID,
+            "version": mod.version,
+            "url": url,
+            "filename": filename,
+            "size": size,
+            "sha1": mod.sha1,
+            "old_file": mod.old_file,
+            "installed": installed(mod),
+            "cached": cached
+        })
+
+    if sizes:
+        unknown = [jar for jar in jars if "url" in jar and jar["size"] is None and not jar["cached"]]
+        lengths = await asyncio.gather(*(api.get_content_length(jar["url"]) for jar in unknown))
+        for jar, length in zip(unknown, lengths):
+            jar["size"] = length
+    return jars
+
+
+async def execute(jars:list):
+    '''
+    Carries out a jar plan and writes the index
 
+    The new jars and the index are committed together, jars that failed to
+    download are left out and the mods they would replace stay installed,
+    so ./mods and the index always match.
 
-    modrinth_api_calls = []
-    download_tasks = []
-    modrinth_lookup = {}
+    Args:
+        jars: plan made by plan()
 
+    Raises:
+        the first download error, after the rest was committed
+    '''
+    with staging.Transaction() as transaction:
+        index = []
+        updates = []
+        install_tasks = []
+        for jar in jars:
+            if jar["action"] == "keep":
+                entry = dict(jar)
+                del entry["action"]
+                index.append(entry)
+                continue
+            updates.append(jar)
+            if jar["action"] == "adopt":
+                install_tasks.append(adopt_jar(transaction, jar))
+            else:
+                install_tasks.append(download_jar(
+                    transaction, jar["url"], jar["filename"], jar["version"], jar["id"], jar.get("old_file"), jar.get("size"), jar.get("sha1")
+                ))
+
+        if any(jar["action"] in ("download", "replace") for jar in jars):
+            logger.info("Downloading jars")
+        else:
+            logger.info("No Jars need to be downloaded")
+        results = await asyncio.gather(*install_tasks, return_exceptions=True)
+        errors = []
+        for jar, result in zip(updates, results):
+            if isinstance(result, BaseException):
+                errors.append(result)
+                logger.error(f"Failed to install {jar['id']} {jar['version']}: {result}")
+                if jar["action"] != "adopt":
+                    transaction.discard(f"./mods/{jar['filename']}")
+                if jar.get("installed") is not None:
+                    index.append(jar["installed"])
+            else:
+                index.append(result)
+        # always rewritten, keeps the stat data fresh so the jars are not hashed again
+        await write_to_index_file(transaction, index)
+        transaction.commit()
+    if errors:
+        raise errors[0]
 
-    for mod in mods:
-        if mod.source_type == "modrinth":
-            modrinth_lookup[mod.ID] = mod
-            modrinth_lookup[mod.modrinth_id] = mod
-        elif mod.source_type == "maven":
-                url,filename = await build_maven_url(mod,repos)
-                download_tasks.append(download_jar(url,filename,mod.version,mod.ID,mod.old_file)) 
-    for mod in mods:
-        if mod.source_type == "modrinth":
-            modrinth_api_calls.append(modrinth.get_versions(mod.modrinth_id,mod.ID))
-
-    results = await asyncio.gather(*modrinth_api_calls)
-
-    for result_batch in results:
-        for project_id in result_batch:
-                mod = modrinth_lookup[project_id]
-                for v in result_batch[project_id]:
-                    if "fabric" in v.get("loaders") and mod.version == v.get("version_number"):
-                        for file in v.get("files"):
-                            if file.get("primary"):
-                                download_tasks.append(download_jar(
-                                    file.get("url"),
-                                    file.get("filename"),
-                                    mod.version,
-                                    mod.ID,
-                                    mod.old_file
-                                ))
-    
-    if download_tasks:
-        logger.info("Downloading jars")
-        existing_mods_index = await convert_to_index(removed)
-        index = await asyncio.gather(*download_tasks)
-        
-        await write_to_index_file(index+existing_mods_index)
-    else:
-        logger.info("No Jars need to be downloaded")
 
+async def main(mc_version:str|None=None):
+    '''
+    Verifys and installs mod jars
+
+    Optional:
+        mc_version=None| minecraft version of the instance, detected if not given
+    '''
+    if mc_version is None:
+        mc_version = await get_mc_version()
+    await execute(await plan(mc_version))
@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import configparser
+from dataclasses import dataclass
+import logging
+import os
+from pathlib import Path
+import sys
+import config
+import networking.api as api
+import tasks.get_assets as get_assets
+import tasks.get_token as get_token
+import tasks.install_norisk_version as install_norisk_version
+import utils.launcher_context as launcher_context
+import utils.store as store
+import utils.tracing as tracing
+
+logger = logging.getLogger("Prefetch")
+
+# the prism data dir the launches use, token files are kept there
+CONFIG_PRISM_DATA_DIR = config.PRISM_DATA_DIR
+
+
+@dataclass
+class Instance():
+    launcher : str
+    name : str
+    # the dir the wrapper runs in(the minecraft dir of a prism instance, the profile dir of the modrinth app)
+    path : Path
+    mc_version : str|None
+
+
+def _data_dir() -> Path:
+    if sys.platform == "win32":
+        return Path(os.environ.get("APPDATA") or Path.home() / "AppData" / "Roaming")
+    if sys.platform == "darwin":
+        return Path.home() / "Library" / "Application Support"
+    return Path(os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share")
+
+
+def default_prism_dir() -> Path:
+    '''
+    Returns prism_data_dir from the config if it is absolute, the default prism data dir otherwise
+    '''
+    configured = Path(config.PRISM_DATA_DIR).expanduser()
+    if configured.is_absolute():
+        return configured
+    return _data_dir() / "PrismLauncher"
+
+
+def default_modrinth_db() -> Path:
+    '''
+    Returns modrinth_data_dir from the config if it is absolute, the app.db of the modrinth app otherwise
+    '''
+    configured = Path(config.MODRINTH_DATA_PATH).expanduser()
+    if configured.is_absolute():
+        return configured
+    return _data_dir() / "ModrinthApp" / "app.db"
+
+
+def is_wrapped(command:str|None) -> bool:
+    '''
+    True if a launcher wrapper command runs this wrapper
+    '''
+    return bool(command) and config.WRAPPER_ROOT.name in command
+
+
+def _read_cfg(path:Path) -> dict:
+    # prism/multimc cfg files are ini files, older ones have no section header
+    parser = configparser.RawConfigParser(strict=False)
+    parser.optionxform = str
+    try:
+        text = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return {}
+    if not text.lstrip().startswith("["):
+        text = f"[General]\n{text}"
+    parser.read_string(text)
+    return dict(parser["General"]) if parser.has_section("General") else {}
+
+
+def discover_prism(prism_dir:Path) -> list[Instance]:
+    '''
+    Finds the prism instances that run this wrapper
+
+    Args:
+        prism_dir: prism data dir(the one with prism.cfg)
+    '''
+    global_cfg = _read_cfg(prism_dir / "prism.cfg")
+    instances_dir = prism_dir / global_cfg.get("InstanceDir", "instances")
+    if not instances_dir.is_dir():
+        return []
+    instances = []
+    for instance_dir in sorted(instances_dir.iterdir()):
+        cfg = _read_cfg(instance_dir / "instance.cfg")
+        if not cfg:
+            continue
+        if cfg.get("OverrideCommands", "false").lower() == "true":
+            command = cfg.get("WrapperCommand")
+        else:
+            command = global_cfg.get("WrapperCommand")
+        if not is_wrapped(command):
+            continue
+        game_dir = instance_dir / "minecraft"
+        if not game_dir.is_dir() and (instance_dir / ".minecraft").is_dir():
+            game_dir = instance_dir / ".minecraft"
+        mc_version, _, _ = launcher_context.read_mmc_pack(instance_dir / "mmc-pack.json")
+        instances.append(Instance("prism", cfg.get("name", instance_dir.name), game_dir, mc_version))
+    return instances
+
+
+def discover_modrinth(db:Path) -> list[Instance]:
+    '''
+    Finds the modrinth app profiles that run this wrapper
+
+    Args:
+        db: the app.db of the modrinth app
+    '''
+    if not db.is_file():
+        return []
+    # only needed for the modrinth app, imported here to keep startup fast for prism
+    import duckdb
+
+    con = duckdb.connect(str(db), read_only=True)
+    try:
+        profiles = con.execute("SELECT path, name, game_version, override_hook_wrapper FROM profiles").fetchall()
+        try:
+            settings = con.execute("SELECT hook_wrapper FROM settings").fetchall()
+        except duckdb.Error:
+            settings = []
+    finally:
+        con.close()
+    global_command = settings[0][0] if settings else None
+    instances = []
+    for path, name, game_version, command in profiles:
+        if is_wrapped(command or global_command):
+            instances.append(Instance("modrinth", name or path, db.parent / "profiles" / path, game_version))
+    return instances
+
+
+def enter(instance:Instance, prism_dir:Path, modrinth_db:Path):
+    '''
+    Makes instance the one the sync tasks work on, they use paths relative to the working dir
+    '''
+    os.chdir(instance.path)
+    config.LAUNCHER = instance.launcher
+    if instance.launcher == "prism":
+        config.PRISM_DATA_DIR = str(prism_dir)
+    else:
+        config.MODRINTH_DATA_PATH = str(modrinth_db)
+        config.PRISM_DATA_DIR = CONFIG_PRISM_DATA_DIR
+    get_token.path = config.PRISM_DATA_DIR
+    os.makedirs("./mods", exist_ok=True)
+
+
+async def _fetch_jar(url:str, filename:str, size:int|None, sha1:str):
+    digests = await api.download_jar(url, filename, store.object_path(sha1, "sha1"), size, sha1, ("sha1", "md5"))
+    store.remember_md5(sha1, digests["md5"])
+
+
+async def fill_store(mc_versions, token:str|None) -> bool:
+    '''
+    Downloads the jars of every minecraft version and the asset pack into the shared store
+
+    The mod sets are resolved once per version and every object is
+    downloaded once, all in one pass through the download scheduler.
+    Jars without an upstream sha1 are left to the instance syncs.
+
+    Args:
+        mc_versions: minecraft versions to prefetch
+        token: norisk token for the asset cdn, assets are skipped if None
+
+    Returns:
+        True if everything was downloaded
+    '''
+    async def sources(mc_version):
+        mods, repos = await install_norisk_version.get_compatible_nrc_mods(mc_version)
+        return await install_norisk_version.resolve_sources(mods, repos)
+
+    resolved = await asyncio.gather(*(sources(mc_version) for mc_version in mc_versions))
+    jars = {}
+    for mod, url, filename, size in (source for version_sources in resolved for source in version_sources):
+        if mod.sha1 and not store.has(mod.sha1, "sha1"):
+            jars.setdefault(mod.sha1, (url, filename, size))
+
+    assets = {}
+    if token:
+        objects = await api.get_asset_metadata("norisk-prod")
+        for path, (digest, size) in objects.items():
+            if path not in get_assets.IGNORE_LIST and not store.has(digest):
+                assets.setdefault(digest, (path, {"hash": digest, "size": size}))
+    else:
+        logger.warning("No norisk token, assets are only fetched by the instance syncs")
+
+    logger.info(f"Prefetching {len(jars)} jars and {len(assets)} assets into the shared store")
+    tasks = [_fetch_jar(url, filename, size, sha1) for sha1, (url, filename, size) in jars.items()]
+    tasks += [
+        api.download_single_asset("norisk-prod", path, asset_info, token, dest=store.object_path(digest))
+        for digest, (path, asset_info) in assets.items()
+    ]
+    with tracing.span("fill store", "prefetch", jars=len(jars), assets=len(assets)) as span:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed = sum(isinstance(result, BaseException) for result in results)
+        span.set(failed=failed)
+    if failed:
+        logger.warning(f"Failed to prefetch {failed} objects")
+    return not failed
+
+
+def parse_args(argv:list):
+    parser = argparse.ArgumentParser(
+        prog="nrc-wrapper.pyz prefetch",
+        description="Downloads everything the NRC instances need, so their next launch has nothing to download"
+    )
+    parser.add_argument("--prism-dir", type=Path, default=default_prism_dir(), help="prism launcher data dir")
+    parser.add_argument("--modrinth-db", type=Path, default=default_modrinth_db(), help="app.db of the modrinth app")
+    return parser.parse_args(argv)
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+from collections import Counter
+import json
+import sys
+import config
+import tasks.get_assets as get_assets
+import tasks.install_norisk_version as install_norisk_version
+
+PLAN_VERSION = 1
+
+
+def summarize(plan:dict) -> dict:
+    '''
+    Counts what executing a plan costs
+
+    Returns:
+        summary:dict | actions per jar/asset, network requests and bytes expected,
+        unknown_sizes: downloads whose size is not known(not included in bytes)
+    '''
+    jars = plan["jars"]
+    assets = plan["assets"]
+    actions = Counter(jar["action"] for jar in jars)
+    jar_downloads = [jar for jar in jars if jar["action"] in ("download", "replace") and not jar["cached"]]
+    if config.USE_SHARED_STORE:
+        # assets with the same content are downloaded once, stored ones are only linked
+        asset_downloads = list({asset["hash"]: asset for asset in assets["fetch"] if not asset["cached"]}.values())
+    else:
+        asset_downloads = assets["fetch"]
+    downloads = jar_downloads + asset_downloads
+    return {
+        "jars": {
+            "keep": actions["keep"],
+            "adopt": actions["adopt"],
+            "download": actions["download"],
+            "replace": actions["replace"],
+            "from_store": sum(jar.get("cached", False) for jar in jars if jar["action"] != "keep"),
+        },
+        "assets": {
+            "total": len(assets["objects"]),
+            "fetch": len(assets["fetch"]),
+            "from_store": len(assets["fetch"]) - len(asset_downloads),
+            "remove": len(assets["remove"]),
+            "full_verify": assets["verified"] is None,
+        },
+        "requests": len(downloads),
+        "bytes": sum(download["size"] or 0 for download in downloads),
+        "unknown_sizes": sum(download["size"] is None for download in downloads),
+    }
+
+
+async def make(mc_version:str|None=None, sizes:bool=False) -> dict:
+    '''
+    Plans the sync of the current instance without changing anything
+
+    Optional:
+        mc_version=None| minecraft version of the instance, detected if not given
+        sizes=False| ask the servers for sizes the metadata does not have(HEAD requests)
+
+    Returns:
+        plan:dict | mc_version, jars(see install_norisk_version.plan), assets(see get_assets.plan) and a summary
+    '''
+    if mc_version is None:
+        mc_version = await install_norisk_version.get_mc_version()
+    jars, assets = await asyncio.gather(install_norisk_version.plan(mc_version, sizes), get_assets.plan())
+    plan = {"version": PLAN_VERSION, "mc_version": mc_version, "jars": jars, "assets": assets}
+    plan["summary"] = summarize(plan)
+    return plan
+
+
+def write(plan:dict, output=None, objects:bool=False):
+    '''
+    Writes plan as json to output(a path) or stdout
+
+    Optional:
+        objects=False| include the md5 of every asset of the pack(one entry per asset path),
+        left out by default as it buries the actual plan
+    '''
+    if not objects:
+        plan = {**plan, "assets": {key: value for key, value in plan["assets"].items() if key != "objects"}}
+    if output is None:
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(output, "w") as f:
+            json.dump(plan, f, indent=2)
+
+
+def parse_args(argv:list):
+    parser = argparse.ArgumentParser(
+        prog="nrc-wrapper.pyz plan",
+        description="Prints what the next launch of the instance in the current dir would download, as json"
+    )
+    parser.add_argument("-o", "--output", help="write the plan to this file instead of stdout")
+    parser.add_argument("--no-head", action="store_true", help="don't ask the servers for unknown download sizes")
+    parser.add_argument("--objects", action="store_true", help="include the hash of every asset of the pack")
+    return parser.parse_args(argv)
@@ -0,0 +1,64 @@
+import asyncio
+import os
+import time
+
+# how often a waiting lock is retried
+POLL_INTERVAL = 0.1
+
+
+def try_lock(path):
+    '''
+    Takes an exclusive lock that is released by the os if the process dies
+
+    Args:
+        path: lock file, created if missing
+
+    Returns:
+        the locked file descriptor or None if someone else holds the lock
+    '''
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        try:
+            try:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except ImportError:
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return None
+        # the previous holder may have unlinked the file before we got the lock,
+        # then this lock is on an orphaned inode and the path has to be opened again
+        try:
+            current = os.stat(path)
+        except FileNotFoundError:
+            current = None
+        locked = os.fstat(fd)
+        if current is not None and (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino):
+            return fd
+        os.close(fd)
+
+
+async def lock(path, timeout:float):
+    '''
+    Waits up to timeout seconds for the lock without blocking the event loop
+
+    Returns:
+        the locked file descriptor or None if it timed out
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        fd = try_lock(path)
+        if fd is not None or time.monotonic() >= deadline:
+            return fd
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def unlock(fd):
+    '''
+    Releases a lock taken with try_lock/lock, None is ignored
+    '''
+    if fd is not None:
+        # closing the descriptor drops the flock/msvcrt lock
+        os.close(fd)
@@ -0,0 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import mmap
+import os
+import utils.tracing as tracing
+
+# hashlib releases the GIL while hashing, so a thread pool scales with the cores
+# without the pickling/startup cost of a process pool
+HASH_WORKERS = os.cpu_count() or 1
+# upper bound of files hashed by one worker call, amortizes the dispatch overhead for small assets
+BATCH_SIZE = 64
+
+_executor: ThreadPoolExecutor|None = None
+_pending = []
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+    return _executor
+
+
+def file_digest(file, algorithm:str|tuple="md5") -> str|dict:
+    '''
+    Hashes a file without copying it into python memory (blocking)
+
+    Args:
+        file: path to a file
+        algorithm: hashlib algorithm name, or a tuple of them to hash the file once with all of them
+
+    Returns:
+        hex digest, a dict algorithm -> hex digest if algorithm is a tuple
+    '''
+    if not isinstance(algorithm, str):
+        digests = [hashlib.new(name) for name in algorithm]
+        with open(file, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m, memoryview(m) as view:
+                    # chunked so every part is hashed by all algorithms while it is in the cpu cache
+                    for start in range(0, len(view), 1024 * 1024):
+                        chunk = view[start:start + 1024 * 1024]
+                        for digest in digests:
+                            digest.update(chunk)
+                        chunk.release()
+        return {name: digest.hexdigest() for name, digest in zip(algorithm, digests)}
+    with open(file, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, algorithm).hexdigest()
+        digest = hashlib.new(algorithm)
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                digest.update(m)
+        return digest.hexdigest()
+
+
+def _hash_batch(batch:list) -> list:
+    results = []
+    for file, algorithm in batch:
+        try:
+            with tracing.span("hash", "hash", file=str(file), algorithm=algorithm) as span:
+                if tracing.enabled:
+                    span.set(bytes=os.path.getsize(file))
+                results.append((file_digest(file, algorithm), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+def _resolve(futures:list, done):
+    if done.cancelled():
+        for fut in futures:
+            fut.cancel()
+        return
+    error = done.exception()
+    results = [(None, error)] * len(futures) if error else done.result()
+    for fut, (digest, exc) in zip(futures, results):
+        if fut.done():
+            continue
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(digest)
+
+
+def _flush():
+    batch = _pending[:]
+    _pending.clear()
+    loop = asyncio.get_running_loop()
+    # spread the files over all workers but never put more than BATCH_SIZE into one call
+    size = max(1, min(BATCH_SIZE, -(-len(batch) // HASH_WORKERS)))
+    for i in range(0, len(batch), size):
+        group = batch[i:i + size]
+        futures = [fut for _, _, fut in group]
+        job = asyncio.wrap_future(
+            get_executor().submit(_hash_batch, [(file, algorithm) for file, algorithm, _ in group]),
+            loop=loop
+        )
+        job.add_done_callback(lambda done, futures=futures: _resolve(futures, done))
+
+
+async def calc_hash(file, algorithm:str|tuple="md5") -> str|dict:
+    '''
+    Calculates the hash for given path off the event loop
+
+    Calls made in the same loop iteration (e.g. from asyncio.gather) are
+    collected and hashed in batches on the worker pool.
+
+    Args:
+        file: path to a file
+        algorithm: hashlib algorithm name, or a tuple of them(see file_digest)
+    '''
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    _pending.append((file, algorithm, fut))
+    if len(_pending) == 1:
+        loop.call_soon(_flush)
+    return await fut
@@ -0,0 +1,155 @@
+import asyncio
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import config
+
+logger = logging.getLogger("Launcher Context")
+
+MMC_PACK_PATH = "../mmc-pack.json"
+# prism component uid -> loader name
+PRISM_LOADERS = {
+    "net.fabricmc.fabric-loader": "fabric",
+    "org.quiltmc.quilt-loader": "quilt",
+    "net.minecraftforge": "forge",
+    "net.neoforged": "neoforge",
+}
+
+
+@dataclass
+class LauncherContext():
+    access_token : str
+    username : str
+    uuid : str
+    mc_version : str|None
+    loader : str|None
+    loader_version : str|None
+
+
+_snapshot: LauncherContext|None = None
+_snapshot_key = None
+_loading: asyncio.Future|None = None
+_loading_key = None
+
+
+def _mtime(path) -> int|None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _source_key() -> tuple:
+    '''
+    Identifies the current state of the launcher files, changes whenever one of them is written
+    '''
+    if config.LAUNCHER == "modrinth":
+        db = config.MODRINTH_DATA_PATH
+        # sqlite commits land in the wal first, the main file keeps its mtime until a checkpoint
+        return ("modrinth", os.getcwd(), _mtime(db), _mtime(f"{db}-wal"))
+    accounts = f"{config.PRISM_DATA_DIR}/accounts.json"
+    return ("prism", os.getcwd(), _mtime(accounts), _mtime(MMC_PACK_PATH))
+
+
+def _read_modrinth() -> LauncherContext:
+    '''
+    Reads the active account and the profile of the current dir from the Modrinth app.db (blocking)
+    '''
+    # only needed for the modrinth app, imported here to keep startup fast for prism
+    import duckdb
+
+    profile_path = Path(os.getcwd()).name
+    con = duckdb.connect(config.MODRINTH_DATA_PATH, read_only=True)
+    try:
+        users = con.execute("SELECT access_token, username, uuid FROM minecraft_users WHERE active = 1").fetchall()
+        profiles = con.execute(
+            "SELECT game_version, mod_loader, mod_loader_version FROM profiles WHERE path = ?",
+            [profile_path]
+        ).fetchall()
+    finally:
+        con.close()
+    if not users:
+        raise Exception("No active Minecraft account in the Modrinth app")
+    if not profiles:
+        raise Exception(f"Profile {profile_path} not found in {config.MODRINTH_DATA_PATH}")
+    access_token, username, uuid = users[0]
+    mc_version, loader, loader_version = profiles[0]
+    return LauncherContext(access_token, username, uuid, mc_version, loader, loader_version)
+
+
+def read_mmc_pack(path=MMC_PACK_PATH) -> tuple:
+    '''
+    Reads the minecraft and loader components of a prism instance (blocking)
+
+    Returns:
+        (mc_version, loader, loader_version), None for everything that is not set
+    '''
+    mc_version = loader = loader_version = None
+    try:
+        with open(path) as f:
+            mmc_pack = json.load(f)
+    except FileNotFoundError:
+        mmc_pack = {}
+    for component in mmc_pack.get("components", []):
+        uid = component.get("uid")
+        if uid == "net.minecraft":
+            mc_version = component.get("version")
+        elif uid in PRISM_LOADERS:
+            loader = PRISM_LOADERS[uid]
+            loader_version = component.get("version")
+    return mc_version, loader, loader_version
+
+
+def _read_prism() -> LauncherContext:
+    '''
+    Reads the active account from accounts.json and the components of the instance from mmc-pack.json (blocking)
+    '''
+    with open(f"{config.PRISM_DATA_DIR}/accounts.json", "r") as f:
+        accounts = json.load(f)
+    active = next((item for item in accounts.get("accounts") if item.get('active')), None)
+    if active is None:
+        raise Exception("No active account in Prism Launcher")
+
+    mc_version, loader, loader_version = read_mmc_pack()
+    return LauncherContext(
+        active.get("ygg").get("token"),
+        active.get("profile").get("name"),
+        active.get("profile").get("id"),
+        mc_version,
+        loader,
+        loader_version,
+    )
+
+
+async def get() -> LauncherContext:
+    '''
+    Returns the launcher context of the current instance
+
+    Each launcher file is read once, all tasks of a launch share the
+    snapshot. It is read again only if one of the files changed since.
+    '''
+    global _snapshot, _snapshot_key, _loading, _loading_key
+    key = _source_key()
+    if _snapshot is not None and key == _snapshot_key:
+        return _snapshot
+    if _loading is None or _loading.done() or _loading_key != key:
+        # concurrent callers wait for the same read
+        reader = _read_modrinth if config.LAUNCHER == "modrinth" else _read_prism
+        _loading = asyncio.ensure_future(asyncio.to_thread(reader))
+        _loading_key = key
+    loading = _loading
+    snapshot = await asyncio.shield(loading)
+    if loading is _loading:
+        logger.debug(f"Read {key[0]} launcher context")
+        _snapshot, _snapshot_key = snapshot, key
+    return snapshot
+
+
+def invalidate():
+    '''
+    Drops the cached snapshot
+    '''
+    global _snapshot, _snapshot_key
+    _snapshot = _snapshot_key = None
@@ -0,0 +1,184 @@
+import asyncio
+import gzip
+import io
+import logging
+from pathlib import Path
+import re
+import signal
+import subprocess
+import sys
+import time
+import config
+
+logger = logging.getLogger("Log Relay")
+
+GAME_LOG_PATH = Path("NoRiskClient/game-logs")
+# bytes read from a pipe at once, every read is written out with one call
+RELAY_CHUNK = 64 * 1024
+# uncompressed bytes per log file before a new one is started
+GAME_LOG_MAX_BYTES = 50 * 1024 * 1024
+# compressed logs kept, the oldest are deleted
+GAME_LOG_KEEP = 10
+CAPTURE_BUFFER = 1024 * 1024
+
+LEVELS = {b"TRACE": 0, b"DEBUG": 10, b"INFO": 20, b"WARN": 30, b"WARNING": 30, b"ERROR": 40, b"FATAL": 50}
+# "[12:34:56] [Render thread/INFO]: ..." (the log4j pattern of minecraft and most launchers)
+LEVEL_PATTERN = re.compile(rb"^\[[^\]]*\] \[[^\]]*/([A-Z]+)\]")
+
+
+class GameLogCapture():
+    '''
+    Tees the game output into rotating gzip files, keeping lines at or above a level
+
+    Lines without a level (stack traces, multi line messages) belong to the
+    line before them on the same stream and are kept or dropped together with it.
+    '''
+
+    def __init__(self, level:str):
+        self.min_level = LEVELS.get(level.upper().encode(), 0)
+        self.partial = {}
+        # stream -> whether the last line with a level was kept
+        self.keep_line = {}
+        self.file = None
+        self.written = 0
+        self.parts = 0
+        self.name = time.strftime("%Y%m%d-%H%M%S")
+
+    def _open(self):
+        GAME_LOG_PATH.mkdir(parents=True, exist_ok=True)
+        suffix = f"-{self.parts}" if self.parts else ""
+        self.parts += 1
+        raw = gzip.open(GAME_LOG_PATH / f"game-{self.name}{suffix}.log.gz", "wb", compresslevel=5)
+        self.file = io.BufferedWriter(raw, CAPTURE_BUFFER)
+        self.written = 0
+        self._cleanup()
+
+    def _cleanup(self):
+        logs = sorted(GAME_LOG_PATH.glob("game-*.log.gz"), key=lambda p: p.stat().st_mtime)
+        for old in logs[:-GAME_LOG_KEEP]:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+    def _keep(self, stream:str, line:bytes) -> bool:
+        match = LEVEL_PATTERN.match(line)
+        if match:
+            self.keep_line[stream] = LEVELS.get(match.group(1), self.min_level) >= self.min_level
+        return self.keep_line.get(stream, True)
+
+    def feed(self, stream:str, data:bytes):
+        '''
+        Adds a chunk read from stream, incomplete lines wait for the next chunk
+        '''
+        data = self.partial.pop(stream, b"") + data
+        lines = data.split(b"\n")
+        if lines[-1]:
+            self.partial[stream] = lines[-1]
+        lines.pop()
+        if not self.min_level:
+            kept = lines
+        else:
+            kept = [line for line in lines if self._keep(stream, line)]
+        if kept:
+            self._write(b"\n".join(kept) + b"\n")
+
+    def _write(self, data:bytes):
+        if self.file is None or self.written >= GAME_LOG_MAX_BYTES:
+            self._close_file()
+            self._open()
+        self.file.write(data)
+        self.written += len(data)
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        '''
+        Writes the unfinished last lines and closes the log
+        '''
+        for stream in list(self.partial):
+            rest = self.partial.pop(stream)
+            if not self.min_level or self._keep(stream, rest):
+                self._write(rest + b"\n")
+        self._close_file()
+
+
+async def _pump(stream:asyncio.StreamReader, name:str, out, capture:GameLogCapture|None):
+    while True:
+        data = await stream.read(RELAY_CHUNK)
+        if not data:
+            break
+        out.write(data)
+        out.flush()
+        if capture is not None:
+            capture.feed(name, data)
+
+
+async def relay(cmd:list, log_level:str|None=None) -> int:
+    '''
+    Runs cmd as a child process and forwards its stdout and stderr
+
+    Both pipes are drained concurrently in large chunks, so the game never
+    blocks on a full pipe and the output is written with few syscalls.
+
+    Args:
+        cmd: command to run
+        log_level: if set the output is also written to GAME_LOG_PATH, keeping lines at or above this level
+
+    Returns:
+        the exit code of the child
+    '''
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=RELAY_CHUNK,
+        **kwargs
+    )
+    loop = asyncio.get_running_loop()
+    forwarded = []
+    if sys.platform != "win32":
+        # the launcher stops the game by signalling us, pass it on
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            loop.add_signal_handler(sig, process.send_signal, sig)
+            forwarded.append(sig)
+
+    capture = GameLogCapture(log_level) if log_level else None
+    try:
+        await asyncio.gather(
+            _pump(process.stdout, "stdout", sys.stdout.buffer, capture),
+            _pump(process.stderr, "stderr", sys.stderr.buffer, capture),
+        )
+        return await process.wait()
+    finally:
+        for sig in forwarded:
+            loop.remove_signal_handler(sig)
+        if capture is not None:
+            capture.close()
+
+
+def use_relay() -> bool:
+    '''
+    True if the game has to run as a child of the wrapper instead of replacing it
+    '''
+    return sys.platform == "win32" or config.LOG_RELAY or bool(config.GAME_LOG_LEVEL)
+
+
+def main(cmd:list) -> int:
+    '''
+    Runs the game through the relay with the configured capture level
+
+    Returns:
+        the exit code of the game
+    '''
+    if config.GAME_LOG_LEVEL:
+        logger.info(f"Starting Minecraft, capturing {config.GAME_LOG_LEVEL}+ output to {GAME_LOG_PATH}..")
+    else:
+        logger.info("Starting Minecraft with log relay..")
+    return asyncio.run(relay(cmd, config.GAME_LOG_LEVEL))
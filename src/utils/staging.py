@@ -0,0 +1,330 @@
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import time
+import utils.file_lock as file_lock
+
+logger = logging.getLogger("Staging")
+
+STAGING_PATH = Path(".nrc-staging")
+FILES_PATH = STAGING_PATH / "files"
+PENDING_PATH = STAGING_PATH / "pending.json"
+LOCK_PATH = STAGING_PATH / "lock"
+STATE_PATH = Path(".nrc-state.json")
+# foreground installs, see Transaction
+INSTALL_PATH = STAGING_PATH / "install"
+JOURNAL_PATH = STAGING_PATH / "journal.json"
+# held for the whole life of a transaction, recover leaves the install area alone while it is taken
+INSTALL_LOCK_PATH = STAGING_PATH / "install.lock"
+# partial downloads without progress for this long are dropped, nothing might ever resume them
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+# an updater holding the lock longer than this is considered dead
+LOCK_TIMEOUT = 60 * 60
+
+# set by the background updater, all changes to the instance are staged instead of applied
+enabled = False
+_ops = {}
+
+
+def stage(dest) -> Path:
+    '''
+    Returns the path a file for dest has to be written to
+
+    When staging is enabled the file goes to the staging area and is moved
+    onto dest by apply_pending on the next start, otherwise it is dest itself.
+
+    Args:
+        dest: final path of the file inside the instance
+    '''
+    if not enabled:
+        return Path(dest)
+    dest = os.path.normpath(dest)
+    staged = FILES_PATH / dest
+    staged.parent.mkdir(parents=True, exist_ok=True)
+    _ops[dest] = {"op": "move", "src": str(staged), "dest": dest}
+    return staged
+
+
+def remove(path):
+    '''
+    Removes a file from the instance (or stages the removal)
+    '''
+    if not enabled:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    path = os.path.normpath(path)
+    _ops[path] = {"op": "remove", "dest": path}
+
+
+def discard():
+    '''
+    Drops leftovers of an earlier, unfinished update
+    '''
+    _ops.clear()
+    try:
+        os.remove(PENDING_PATH)
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(FILES_PATH, ignore_errors=True)
+
+
+def _write_ops(path:Path, ops:list):
+    '''
+    Atomically writes a list of changes, the file is either complete or not there
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"created": time.time(), "ops": ops}, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _apply_ops(ops:list):
+    '''
+    Carries out a list of changes, every change can be repeated if it was already applied
+    '''
+    for op in ops:
+        dest = Path(op["dest"])
+        if op["op"] == "move":
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(op["src"], dest)
+            except FileNotFoundError:
+                # already applied
+                pass
+        elif op["op"] == "remove":
+            try:
+                os.remove(dest)
+            except FileNotFoundError:
+                pass
+
+
+def commit():
+    '''
+    Atomically publishes the staged changes for the next start
+    '''
+    if not enabled or not _ops:
+        return
+    _write_ops(PENDING_PATH, list(_ops.values()))
+    logger.info(f"Staged {len(_ops)} changes for the next launch")
+
+
+def apply_pending():
+    '''
+    Applies changes staged by a previous background update
+    '''
+    if not PENDING_PATH.is_file() or is_locked():
+        return
+    with open(PENDING_PATH) as f:
+        pending = json.load(f)
+    _apply_ops(pending.get("ops", []))
+    os.remove(PENDING_PATH)
+    shutil.rmtree(FILES_PATH, ignore_errors=True)
+    logger.info(f"Applied {len(pending.get('ops', []))} staged changes")
+
+
+class Transaction():
+    '''
+    Installs a set of files into the instance all at once
+
+    New files are written to the install area and removals are only
+    recorded. commit writes all swaps to a journal first and then carries
+    them out, if the wrapper dies in between recover replays the journal on
+    the next start. Nothing of a transaction that was not committed reaches
+    the instance.
+
+    While the background updater runs the changes go to the staging area
+    (see stage/remove) and are applied with the rest of the update.
+
+    Example:
+        with Transaction() as transaction:
+            await download(url, transaction.stage("./mods/new.jar"))
+            transaction.remove("./mods/old.jar")
+            transaction.commit()
+    '''
+
+    def __init__(self):
+        self.ops = {}
+        self.lock = None
+
+    def __enter__(self):
+        if not enabled:
+            STAGING_PATH.mkdir(exist_ok=True)
+            self.lock = file_lock.try_lock(INSTALL_LOCK_PATH)
+            if self.lock is None:
+                raise Exception("Another launch is installing into this instance right now")
+            # the journal of an interrupted transaction must not be overwritten
+            _recover()
+        return self
+
+    def __exit__(self, *exc):
+        file_lock.unlock(self.lock)
+        self.lock = None
+
+    def stage(self, dest) -> Path:
+        '''
+        Returns the path a file for dest has to be written to
+        '''
+        if enabled:
+            return stage(dest)
+        dest = os.path.normpath(dest)
+        staged = INSTALL_PATH / dest
+        staged.parent.mkdir(parents=True, exist_ok=True)
+        self.ops[dest] = {"op": "move", "src": str(staged), "dest": dest}
+        return staged
+
+    def remove(self, path):
+        '''
+        Records that path is removed on commit
+        '''
+        if enabled:
+            remove(path)
+            return
+        path = os.path.normpath(path)
+        # a new file for the same path wins over the removal
+        self.ops.setdefault(path, {"op": "remove", "dest": path})
+
+    def discard(self, dest):
+        '''
+        Drops the file staged for dest, e.g. after its download failed
+        '''
+        if enabled:
+            return
+        dest = os.path.normpath(dest)
+        op = self.ops.get(dest)
+        if op is None or op["op"] != "move":
+            return
+        del self.ops[dest]
+        try:
+            os.remove(op["src"])
+        except FileNotFoundError:
+            pass
+
+    def commit(self):
+        '''
+        Applies all recorded changes, crash safe
+        '''
+        if enabled or not self.ops:
+            return
+        ops = list(self.ops.values())
+        _write_ops(JOURNAL_PATH, ops)
+        _apply_ops(ops)
+        os.remove(JOURNAL_PATH)
+        self.ops = {}
+        logger.debug(f"Committed {len(ops)} changes")
+
+
+def recover():
+    '''
+    Finishes or rolls back a foreground install that was interrupted
+
+    A journal means the install was committed, its remaining changes are
+    applied. Files staged without a journal were never committed and are
+    dropped, resumable partial downloads are kept until PARTIAL_MAX_AGE
+    passed without progress. Nothing is done while a transaction of another
+    process is running.
+    '''
+    if not JOURNAL_PATH.is_file() and not INSTALL_PATH.is_dir():
+        return
+    lock = file_lock.try_lock(INSTALL_LOCK_PATH)
+    if lock is None:
+        logger.debug("An install is running, nothing to recover")
+        return
+    try:
+        _recover()
+    finally:
+        file_lock.unlock(lock)
+
+
+def _recover():
+    # the install lock has to be held
+    if JOURNAL_PATH.is_file():
+        with open(JOURNAL_PATH) as f:
+            ops = json.load(f).get("ops", [])
+        _apply_ops(ops)
+        os.remove(JOURNAL_PATH)
+        logger.info(f"Finished {len(ops)} changes of an interrupted install")
+    if not INSTALL_PATH.is_dir():
+        return
+    dropped = 0
+    expired = 0
+    now = time.time()
+    for path in list(INSTALL_PATH.rglob("*")):
+        if not path.is_file():
+            continue
+        if path.name.endswith((".part", ".part.json")):
+            # the state file is checkpointed while downloading, a part without one can't be resumed
+            state = path if path.name.endswith(".part.json") else path.with_name(f"{path.name}.json")
+            try:
+                if now - state.stat().st_mtime < PARTIAL_MAX_AGE:
+                    continue
+            except FileNotFoundError:
+                pass
+            expired += path.name.endswith(".part")
+        elif not path.name.endswith(".part.lock"):
+            dropped += 1
+        os.remove(path)
+    if dropped:
+        logger.info(f"Rolled back {dropped} files of an interrupted install")
+    if expired:
+        logger.info(f"Dropped {expired} partial downloads that will not be resumed")
+
+
+def is_locked() -> bool:
+    try:
+        return time.time() - LOCK_PATH.stat().st_mtime < LOCK_TIMEOUT
+    except FileNotFoundError:
+        return False
+
+
+def acquire_lock() -> bool:
+    '''
+    Takes the updater lock, only one background updater may run per instance
+
+    Returns:
+        True if the lock was acquired
+    '''
+    STAGING_PATH.mkdir(exist_ok=True)
+    if LOCK_PATH.exists() and not is_locked():
+        # stale lock of a crashed updater
+        os.remove(LOCK_PATH)
+    try:
+        fd = os.open(LOCK_PATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release_lock():
+    try:
+        os.remove(LOCK_PATH)
+    except FileNotFoundError:
+        pass
+
+
+def read_state() -> dict:
+    try:
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_state(mc_version:str):
+    '''
+    Records that the instance was completely verified for mc_version
+    '''
+    dest = stage(STATE_PATH)
+    tmp = dest.with_name(f"{dest.name}.tmp")
+    with open(tmp, "w") as f:
+        json.dump({"mc_version": mc_version, "verified": time.time()}, f, indent=2)
+    os.replace(tmp, dest)
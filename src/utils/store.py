@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import shutil
+import stat
+import sys
+import config
+
+logger = logging.getLogger("Store")
+
+STORE_PATH = config.CACHE_DIR / "store"
+OBJECTS_PATH = STORE_PATH / "objects"
+URLS_PATH = STORE_PATH / "urls"
+
+# linux FICLONE ioctl, copy-on-write clone on btrfs/xfs/bcachefs
+FICLONE = 0x40049409
+
+
+def object_path(digest:str, algorithm:str="md5") -> Path:
+    '''
+    Returns the location of an object in the store
+
+    Args:
+        digest: hex digest of the content
+        algorithm: hash algorithm the digest was made with
+    '''
+    return OBJECTS_PATH / algorithm / digest[:2] / digest
+
+
+def is_object(path) -> bool:
+    '''
+    True if path is an object in the store, its content is given by its name
+    '''
+    return Path(os.path.abspath(path)).is_relative_to(os.path.abspath(OBJECTS_PATH))
+
+
+def has(digest:str|None, algorithm:str="md5") -> bool:
+    if not config.USE_SHARED_STORE or not digest:
+        return False
+    return object_path(digest, algorithm).is_file()
+
+
+def _seal(path:Path):
+    # objects are shared by every instance, make accidental in place writes fail
+    if sys.platform != "win32":
+        mode = path.stat().st_mode
+        if mode & 0o222:
+            os.chmod(path, stat.S_IMODE(mode) & ~0o222)
+
+
+def _reflink(src:Path, dest:Path) -> bool:
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dest)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+def _materialize(src:Path, dest:Path):
+    '''
+    Places src at dest by hardlink, reflink or copy (first one that works)
+    '''
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        # other filesystem, too many links or no hardlink support
+        pass
+    if not _reflink(src, dest):
+        shutil.copyfile(src, dest)
+
+
+def link(digest:str, dest, algorithm:str="md5") -> bool:
+    '''
+    Fills dest with the stored object, replacing dest atomically
+
+    Args:
+        digest: hex digest of the content
+        dest: target path inside the instance
+        algorithm: hash algorithm the digest was made with
+
+    Returns:
+        True if the object was in the store, False otherwise
+    '''
+    if not has(digest, algorithm):
+        return False
+    src = object_path(digest, algorithm)
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dest.with_name(f"{dest.name}.{os.getpid()}.link")
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
+        pass
+    _seal(src)
+    _materialize(src, tmp)
+    os.replace(tmp, dest)
+    return True
+
+
+def add(path, digest:str, algorithm:str="md5"):
+    '''
+    Adds an existing file to the store
+
+    Args:
+        path: file with the given digest
+        digest: hex digest of the content
+        algorithm: hash algorithm the digest was made with
+    '''
+    if not config.USE_SHARED_STORE or not digest:
+        return
+    obj = object_path(digest, algorithm)
+    if obj.is_file():
+        return
+    obj.parent.mkdir(parents=True, exist_ok=True)
+    tmp = obj.with_name(f"{obj.name}.{os.getpid()}.add")
+    try:
+        _materialize(Path(path), tmp)
+        os.replace(tmp, obj)
+        _seal(obj)
+    except OSError as e:
+        logger.warning(f"Failed to add {path} to the store: {e}")
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+
+
+def _md5_path(digest:str, algorithm:str) -> Path:
+    return object_path(digest, algorithm).with_name(f"{digest}.md5")
+
+
+def lookup_md5(digest:str, algorithm:str="sha1") -> str|None:
+    '''
+    Returns the md5 digest of an object stored under another algorithm, None if it was not recorded
+    '''
+    if not config.USE_SHARED_STORE or not digest:
+        return None
+    try:
+        return _md5_path(digest, algorithm).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def remember_md5(digest:str, md5:str, algorithm:str="sha1"):
+    '''
+    Records the md5 digest of an object stored under another algorithm, next to the object
+    '''
+    if not config.USE_SHARED_STORE or not digest or not md5:
+        return
+    path = _md5_path(digest, algorithm)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(md5)
+    os.replace(tmp, path)
+
+
+def _url_key(url:str) -> Path:
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return URLS_PATH / key[:2] / key
+
+
+def lookup_url(url:str) -> str|None:
+    '''
+    Returns the md5 digest of the content last downloaded from url
+    '''
+    if not config.USE_SHARED_STORE:
+        return None
+    try:
+        return _url_key(url).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def remember_url(url:str, digest:str):
+    '''
+    Records which object url resolves to, only for immutable (versioned) urls
+    '''
+    if not config.USE_SHARED_STORE or not digest:
+        return
+    path = _url_key(url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(digest)
+    os.replace(tmp, path)
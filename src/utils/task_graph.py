@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import utils.tracing as tracing
+
+logger = logging.getLogger("Scheduler")
+
+
+class TaskGraph():
+    '''
+    Runs coroutines on one event loop as soon as the tasks they depend on are done
+
+    Example:
+        graph = TaskGraph()
+        graph.add("token", get_token)
+        graph.add("metadata", get_metadata)
+        graph.add("download", download, deps=("token", "metadata"))
+        results = await graph.run()
+    '''
+
+    def __init__(self):
+        self.nodes = {}
+        self.timings = {}
+
+    def add(self, name:str, func, deps:tuple=()):
+        '''
+        Adds a task to the graph
+
+        Args:
+            name: unique task name
+            func: coroutine function, called with the results of deps as positional arguments
+            deps: names of the tasks that have to finish first
+        '''
+        if name in self.nodes:
+            raise ValueError(f"Duplicate task {name}")
+        self.nodes[name] = (func, tuple(deps))
+
+    async def run(self) -> dict:
+        '''
+        Runs all tasks, cancelling the rest if one fails
+
+        Returns:
+            results:dict | task name -> result
+        '''
+        for name, (_, deps) in self.nodes.items():
+            for dep in deps:
+                if dep not in self.nodes:
+                    raise ValueError(f"Task {name} depends on unknown task {dep}")
+
+        loop = asyncio.get_running_loop()
+        self.origin = loop.time()
+        tasks = {}
+
+        async def run_node(name):
+            func, deps = self.nodes[name]
+            args = [await tasks[dep] for dep in deps]
+            start = loop.time()
+            try:
+                with tracing.span(name, "phase"):
+                    return await func(*args)
+            finally:
+                self.timings[name] = (start - self.origin, loop.time() - self.origin)
+
+        for name in self.nodes:
+            tasks[name] = asyncio.ensure_future(run_node(name))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        self.log_critical_path()
+        return {name: task.result() for name, task in tasks.items()}
+
+    def critical_path(self) -> list:
+        '''
+        Returns the chain of tasks that bounded the total runtime
+
+        Starts at the task that finished last and walks back over the
+        dependency that finished last, since that one delayed the start.
+
+        Returns:
+            path:list | (name, start, end) in execution order
+        '''
+        if not self.timings:
+            return []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = []
+        while name is not None:
+            path.append((name, *self.timings[name]))
+            deps = [dep for dep in self.nodes[name][1] if dep in self.timings]
+            name = max(deps, key=lambda n: self.timings[n][1]) if deps else None
+        return list(reversed(path))
+
+    def log_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return
+        chain = " -> ".join(f"{name} ({end - start:.2f}s)" for name, start, end in path)
+        logger.info(f"Critical path {path[-1][2]:.2f}s: {chain}")
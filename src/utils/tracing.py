@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+import config
+
+logger = logging.getLogger("Tracing")
+
+TRACE_PATH = config.CACHE_DIR / "traces"
+# older traces are deleted so the folder doesn't grow forever
+TRACE_KEEP = 20
+
+enabled = config.TRACE
+
+_origin = time.perf_counter_ns()
+_events = []
+_task_ids = weakref.WeakKeyDictionary()
+# never reused, rows of finished tasks stay in the trace
+_next_task_id = itertools.count(1)
+_named_threads = set()
+
+
+def _now() -> float:
+    return (time.perf_counter_ns() - _origin) / 1000
+
+
+def _tid() -> int:
+    '''
+    Every asyncio task gets its own row in the trace, spans of one task always nest
+    '''
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        tid = threading.get_ident()
+        if tid not in _named_threads:
+            _named_threads.add(tid)
+            _metadata("thread_name", tid, threading.current_thread().name)
+        return tid
+    tid = _task_ids.get(task)
+    if tid is None:
+        tid = _task_ids[task] = next(_next_task_id)
+        _metadata("thread_name", tid, task.get_name())
+    return tid
+
+
+def _metadata(name:str, tid:int, value:str):
+    _events.append({"name": name, "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": value}})
+
+
+class Span():
+    '''
+    A timed section, use as `with tracing.span("name") as span:` (or async with)
+    '''
+    __slots__ = ("name", "cat", "args", "start", "tid")
+
+    def __init__(self, name:str, cat:str, args:dict):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **args):
+        '''
+        Adds arguments (bytes, status, cache, ...) shown with the span
+        '''
+        self.args.update(args)
+
+    def __enter__(self):
+        self.tid = _tid()
+        self.start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _events.append({
+            "name": self.name,
+            "cat": self.cat,
+            "ph": "X",
+            "ts": self.start,
+            "dur": _now() - self.start,
+            "pid": os.getpid(),
+            "tid": self.tid,
+            "args": self.args,
+        })
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+
+class _NullSpan():
+    '''
+    Returned while tracing is disabled, does nothing
+    '''
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(name:str, cat:str="phase", **args):
+    '''
+    Starts a span, a shared no-op object if tracing is disabled
+
+    Args:
+        name: shown in the trace viewer
+        cat: category (phase, http, download, hash, ...)
+        args: extra data stored with the span
+    '''
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, cat, args)
+
+
+def instant(name:str, cat:str="event", **args):
+    '''
+    Records a point in time (a retry, a cache hit, ...)
+    '''
+    if not enabled:
+        return
+    _events.append({
+        "name": name, "cat": cat, "ph": "i", "s": "t", "ts": _now(),
+        "pid": os.getpid(), "tid": _tid(), "args": args,
+    })
+
+
+def write(name:str="launch"):
+    '''
+    Writes the recorded events as a chrome trace (chrome://tracing or ui.perfetto.dev)
+
+    Args:
+        name: file name prefix
+
+    Returns:
+        path of the trace or None if tracing is disabled
+    '''
+    if not enabled or not _events:
+        return None
+    TRACE_PATH.mkdir(parents=True, exist_ok=True)
+    path = TRACE_PATH / f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.json"
+    events = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": f"nrc-wrapper {name}"}}]
+    events.extend(_events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"cwd": os.getcwd()}}, f)
+    _events.clear()
+    old = sorted(TRACE_PATH.glob("*.json"), key=lambda p: p.stat().st_mtime)
+    for stale in old[:-TRACE_KEEP]:
+        try:
+            stale.unlink()
+        except OSError:
+            pass
+    logger.info(f"Trace written to {path}")
+    return path
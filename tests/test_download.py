@@ -0,0 +1,127 @@
+'''
+Checks that downloads complete against a local stand-in server that drops connections mid-stream
+
+usage: python -m unittest discover tests (or pytest)
+'''
+import hashlib
+import os
+from pathlib import Path
+import sys
+import tempfile
+import unittest
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+import networking.client as client
+import networking.download as download
+
+CHUNK_SIZE = 16 * 1024
+
+
+class FlakyServer():
+    '''
+    Serves one file with ETag/Range support and cuts the first drops responses off halfway,
+    with ranges=False it advertises ranges but ignores the Range header
+    '''
+    def __init__(self, body:bytes, drops:int, ranges:bool=True):
+        self.body = body
+        self.drops = drops
+        self.ranges = ranges
+        self.requests = []
+
+    async def handle(self, request):
+        etag = f'"{hashlib.md5(self.body).hexdigest()}"'
+        self.requests.append(request.headers.get("Range"))
+        start = 0
+        status = 200
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        range_header = request.headers.get("Range", "")
+        if self.ranges and range_header.startswith("bytes=") and request.headers.get("If-Range") == etag:
+            start = int(range_header[6:].split("-", 1)[0])
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{len(self.body) - 1}/{len(self.body)}"
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(self.body) - start
+        await response.prepare(request)
+        drop_at = None
+        if self.drops:
+            self.drops -= 1
+            drop_at = start + (len(self.body) - start) // 2
+        for offset in range(start, len(self.body), CHUNK_SIZE):
+            chunk = self.body[offset:offset + CHUNK_SIZE]
+            if drop_at is not None and offset + len(chunk) > drop_at:
+                request.transport.close()
+                return response
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+class DownloadTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = Path(self.tmp.name) / "mod.jar"
+        self.retry_delay = download.RETRY_DELAY
+        download.RETRY_DELAY = 0
+
+    async def asyncTearDown(self):
+        download.RETRY_DELAY = self.retry_delay
+        await client.close()
+        await self.runner.cleanup()
+        self.tmp.cleanup()
+
+    async def serve(self, server:FlakyServer) -> str:
+        app = web.Application()
+        app.router.add_get("/file", server.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://127.0.0.1:{port}/file"
+
+    async def test_small_download_restarts(self):
+        body = os.urandom(200 * 1024)
+        server = FlakyServer(body, drops=2)
+        url = await self.serve(server)
+        digest = await download.stream_download(url, self.dest, hashlib.md5(body).hexdigest())
+        self.assertEqual(digest, hashlib.md5(body).hexdigest())
+        self.assertEqual(self.dest.read_bytes(), body)
+        self.assertEqual(server.requests, [None, None, None])
+
+    async def test_large_download_resumes(self):
+        body = os.urandom(3 * download.RESUME_MIN_SIZE)
+        server = FlakyServer(body, drops=2)
+        url = await self.serve(server)
+        digest = await download.stream_download(url, self.dest, hashlib.sha1(body).hexdigest(), "sha1")
+        self.assertEqual(digest, hashlib.sha1(body).hexdigest())
+        self.assertEqual(self.dest.read_bytes(), body)
+        self.assertIsNone(server.requests[0])
+        self.assertTrue(all(header and header.startswith("bytes=") for header in server.requests[1:]))
+        self.assertFalse(self.dest.with_name("mod.jar.part.json").exists())
+
+    async def test_resumes_in_the_next_call(self):
+        body = os.urandom(3 * download.RESUME_MIN_SIZE)
+        server = FlakyServer(body, drops=download.RESUME_ATTEMPTS)
+        url = await self.serve(server)
+        with self.assertRaises(download.RETRYABLE_ERRORS):
+            await download.stream_download(url, self.dest)
+        self.assertFalse(self.dest.exists())
+        self.assertTrue(self.dest.with_name("mod.jar.part.json").is_file())
+        digest = await download.stream_download(url, self.dest)
+        self.assertEqual(digest, hashlib.md5(body).hexdigest())
+        self.assertEqual(self.dest.read_bytes(), body)
+        self.assertTrue(server.requests[-1].startswith("bytes="))
+
+    async def test_range_ignored(self):
+        body = os.urandom(3 * download.RESUME_MIN_SIZE)
+        server = FlakyServer(body, drops=2, ranges=False)
+        url = await self.serve(server)
+        digest = await download.stream_download(url, self.dest)
+        self.assertEqual(digest, hashlib.md5(body).hexdigest())
+        self.assertEqual(self.dest.read_bytes(), body)
+        self.assertTrue(server.requests[1].startswith("bytes="))
+
+
+if __name__ == "__main__":
+    unittest.main()